@@ -1,79 +1,294 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 
 BACKEND_URL = "http://localhost:8000"
+# (connect, read) timeouts in seconds; triage reads wait for the model
+TIMEOUT = (3.05, 15)
+TRIAGE_TIMEOUT = (3.05, 120)
+# Attempts for idempotent calls, with jittered exponential backoff between them
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = {502, 503, 504}
+# Questionnaire is reused this long before it is revalidated with its ETag
+QUESTIONS_TTL = 300
+# Triage results kept per browser session, keyed by answers hash
+MAX_MEMOIZED_RESULTS = 32
+# Re-render only the questionnaire section that changed (st.fragment, Streamlit >= 1.37);
+# TRIAGE_APP_FRAGMENTS=0 reruns the whole page on every answer, for comparison
+USE_FRAGMENTS = os.environ.get("TRIAGE_APP_FRAGMENTS", "1") != "0" and hasattr(st, "fragment")
+DEFAULT_OPTIONS = {"Yes": {"en": "Yes", "ml": "അതെ"}, "No": {"en": "No", "ml": "അല്ല"}}
 
 st.set_page_config(page_title="Pediatric Triage MVP", page_icon="🏥", layout="wide")
+run_started = time.perf_counter()
+
+# -----------------------------
+# BACKEND CLIENT
+# -----------------------------
+@st.cache_resource
+def get_session():
+    # One pooled keep-alive session shared by every rerun and browser session
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def retry_delay(attempt, response=None):
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return min(float(response.headers["Retry-After"]), 10.0)
+    # Full jitter keeps retrying tablets from arriving in lockstep
+    return random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+
+def backend_get(path, **kwargs):
+    """GET with retries on connection errors, timeouts and 502/503/504."""
+    kwargs.setdefault("timeout", TIMEOUT)
+    for attempt in range(RETRY_ATTEMPTS):
+        last = attempt == RETRY_ATTEMPTS - 1
+        try:
+            res = get_session().get(f"{BACKEND_URL}{path}", **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if last:
+                raise
+            time.sleep(retry_delay(attempt))
+            continue
+        if res.status_code in RETRY_STATUSES and not last:
+            time.sleep(retry_delay(attempt, res))
+            continue
+        res.raise_for_status()
+        return res
+
+def backend_post(path, payload, **kwargs):
+    """
+    POST, retried only when the backend turned it away unprocessed (503 with
+    Retry-After from a full inference queue); triage is never sent twice otherwise.
+    """
+    kwargs.setdefault("timeout", TRIAGE_TIMEOUT)
+    for attempt in range(RETRY_ATTEMPTS):
+        res = get_session().post(f"{BACKEND_URL}{path}", json=payload, **kwargs)
+        if res.status_code == 503 and "Retry-After" in res.headers and attempt < RETRY_ATTEMPTS - 1:
+            res.close()
+            time.sleep(retry_delay(attempt, res))
+            continue
+        res.raise_for_status()
+        return res
+
+@st.cache_resource
+def questions_store():
+    # lang -> (etag, sections, fetched at); shared across sessions, failures never stored
+    return {"lock": threading.Lock(), "entries": {}}
+
+def prepare_sections(questions, lang):
+    """
+    Flatten the questionnaire once per payload into what the widgets need,
+    with option labels resolved for `lang` instead of per-rerun lambdas.
+    """
+    sections = []
+    for cat, qs in questions.items():
+        items = []
+        for q_id, q_data in qs.items():
+            label = q_data.get(lang, q_data.get("en", q_id))
+            if q_data["type"] == "number":
+                items.append((q_id, "number", label, (q_data["min"], q_data["max"])))
+            elif q_data["type"] == "radio":
+                options = q_data.get("options", DEFAULT_OPTIONS)
+                labels = {value: names.get(lang, value) for value, names in options.items()}
+                items.append((q_id, "radio", label, (list(options), labels, bool(q_data.get("is_critical")))))
+        sections.append((cat, items))
+    return sections
+
+def get_questions(lang):
+    store = questions_store()
+    with store["lock"]:
+        entry = store["entries"].get(lang)
+    if entry and time.monotonic() - entry[2] < QUESTIONS_TTL:
+        return entry[1]
+    try:
+        headers = {"If-None-Match": entry[0]} if entry and entry[0] else {}
+        res = backend_get("/questions", params={"lang": lang}, headers=headers)
+        if res.status_code == 304:
+            entry = (entry[0], entry[1], time.monotonic())
+        else:
+            entry = (res.headers.get("ETag"), prepare_sections(res.json(), lang), time.monotonic())
+        with store["lock"]:
+            store["entries"][lang] = entry
+        return entry[1]
+    except Exception:
+        if entry:
+            # Serve the last good copy while the backend is unreachable
+            return entry[1]
+        st.error("Cannot connect to backend server. Please ensures the FastAPI server is running.")
+        return []
+
+def answers_hash(answers, language, fast):
+    canonical = json.dumps({"answers": answers, "language": language, "fast": fast}, sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+def diagnostics():
+    if "diagnostics" not in st.session_state:
+        st.session_state["diagnostics"] = {
+            "full_reruns": 0, "section_reruns": 0, "last_full_ms": 0.0, "last_section_ms": 0.0
+        }
+    return st.session_state["diagnostics"]
+
+def memoized_results():
+    if "triage_results" not in st.session_state:
+        st.session_state["triage_results"] = {}
+    return st.session_state["triage_results"]
+
+def remember_result(key, data):
+    results = memoized_results()
+    results.pop(key, None)
+    results[key] = data
+    while len(results) > MAX_MEMOIZED_RESULTS:
+        results.pop(next(iter(results)))
 
 # Language Selection
 st.sidebar.title("Settings")
 lang_choice = st.sidebar.radio("Select Language / ഭാഷ തിരഞ്ഞെടുക്കുക:", ["English", "Malayalam"])
 l_key = "en" if lang_choice == "English" else "ml"
+fast_mode = st.sidebar.toggle("Fast result (general advice, reasoning follows)", value=False)
 
 st.title("🏥 Pediatric Triage System (MVP)")
 st.caption("A decoupled architecture with FastAPI and Streamlit.")
 
 # Fetch questions from backend
-@st.cache_data
-def get_questions():
+SECTIONS = get_questions(l_key)
+
+def show_level(box, level):
+    color = "red" if level == "RED" else "orange" if level == "YELLOW" else "green"
+    box.markdown(f"### Triage Level: :{color}[{level}]")
+
+def show_result(data, level_box, reasoning_box):
+    # Display Results
+    show_level(level_box, data["triage_level"])
+    if data.get("reasoning"):
+        reasoning_box.info(data["reasoning"])
+
+    if data.get("advice_texts"):
+        st.subheader("Home Care Advice")
+        if data.get("generic_advice"):
+            st.caption("General advice for this triage level, not tailored to these answers.")
+        for advice in data["advice_texts"]:
+            st.write(f"- {advice}")
+
+    st.divider()
+    st.write(f"**Confidence:** {data['confidence']}")
+
+def fetch_triage(payload, level_box):
+    if fast_mode:
+        # Scored level and generic advice come back first; reasoning is fetched afterwards
+        return backend_post("/triage", dict(payload, defer_reasoning=True)).json()
+    # Stream so the triage level shows up before the reasoning is finished
+    data = None
+    with backend_post("/triage/stream", payload, stream=True) as res:
+        event = None
+        for line in res.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                body = json.loads(line[len("data:"):])
+                if event == "triage_level":
+                    show_level(level_box, body["triage_level"])
+                elif event == "result":
+                    data = body
+    if data is None:
+        raise RuntimeError("Backend closed the stream without a result")
+    return data
+
+def fetch_reasoning(key, data, reasoning_box):
+    reasoning_box.caption("Preparing explanation...")
     try:
-        response = requests.get(f"{BACKEND_URL}/questions")
-        return response.json()
-    except:
-        st.error("Cannot connect to backend server. Please ensures the FastAPI server is running.")
-        return {}
+        # Long-poll until the reasoning is generated
+        for _ in range(6):
+            reasoning = backend_get(
+                f"/triage/{data['assessment_id']}/reasoning", params={"wait": 10}, timeout=(3.05, 15)
+            ).json()
+            if reasoning["status"] != "pending":
+                reasoning_box.info(reasoning["reasoning"])
+                remember_result(key, dict(data, reasoning=reasoning["reasoning"], reasoning_pending=False))
+                break
+        else:
+            reasoning_box.caption("Explanation is taking longer than expected.")
+    except Exception as e:
+        reasoning_box.warning(f"Could not fetch explanation: {e}")
 
-QUESTIONS = get_questions()
+def render_section(cat, items):
+    started = time.perf_counter()
+    with st.expander(f"{cat}", expanded=True):
+        for q_id, kind, label, extra in items:
+            if kind == "number":
+                st.number_input(label, min_value=extra[0], max_value=extra[1], key=q_id)
+            else:
+                options, labels, is_critical = extra
+                value = st.radio(label, options=options, format_func=labels.get, key=q_id, horizontal=True)
+                if is_critical and value == "Yes":
+                    st.warning("⚠️ High risk flag.")
+    return (time.perf_counter() - started) * 1000
 
-if QUESTIONS:
+if USE_FRAGMENTS:
+    @st.fragment
+    def section_fragment(cat, items):
+        # Answer changes rerun only this section; the full page reruns on submit
+        elapsed = render_section(cat, items)
+        stats = diagnostics()
+        if st.session_state.get("_full_run_active"):
+            return
+        stats["section_reruns"] += 1
+        stats["last_section_ms"] = elapsed
+        if st.session_state.get("_result_shown"):
+            # The result panel is outside the fragment and would go on showing
+            # the previous answers' result; rerun the page so it is cleared
+            st.rerun(scope="app")
+else:
+    section_fragment = render_section
+
+if SECTIONS:
     col1, col2 = st.columns([2, 1])
-    answers = {}
 
     with col1:
         # Build UI dynamically from API questions
-        for cat, qs in QUESTIONS.items():
-            with st.expander(f"{cat}", expanded=True):
-                for q_id, q_data in qs.items():
-                    label = q_data.get(l_key, q_data.get("en", q_id))
-                    
-                    if q_data["type"] == "number":
-                        answers[q_id] = st.number_input(label, min_value=q_data["min"], max_value=q_data["max"], key=q_id)
-                    elif q_data["type"] == "radio":
-                        options = q_data.get("options", {"Yes": {"en": "Yes", "ml": "അതെ"}, "No": {"en": "No", "ml": "അല്ല"}})
-                        answers[q_id] = st.radio(
-                            label,
-                            options=list(options.keys()),
-                            format_func=lambda x: options[x].get(l_key, x),
-                            key=q_id, horizontal=True
-                        )
-                        if q_data.get("is_critical") and answers[q_id] == "Yes":
-                            st.warning("⚠️ High risk flag.")
+        st.session_state["_full_run_active"] = True
+        for cat, items in SECTIONS:
+            section_fragment(cat, items)
+        st.session_state["_full_run_active"] = False
+    answers = {q_id: st.session_state.get(q_id) for _, items in SECTIONS for q_id, *_ in items}
 
     with col2:
         st.subheader("Assessment / വിലയിരുത്തൽ")
-        if st.button("Get Triage Result / ഫലം ലഭിക്കുക", use_container_width=True):
-            with st.spinner("Analyzing via Backend..."):
-                try:
-                    payload = {"answers": answers, "language": l_key}
-                    res = requests.post(f"{BACKEND_URL}/triage", json=payload)
-                    data = res.json()
-                    
-                    # Display Results
-                    level = data["triage_level"]
-                    color = "red" if level == "RED" else "orange" if level == "YELLOW" else "green"
-                    
-                    st.markdown(f"### Triage Level: :{color}[{level}]")
-                    st.info(data["reasoning"])
-                    
-                    if data.get("advice_texts"):
-                        st.subheader("Home Care Advice")
-                        for advice in data["advice_texts"]:
-                            st.write(f"- {advice}")
-                    
-                    st.divider()
-                    st.write(f"**Confidence:** {data['confidence']}")
-                except Exception as e:
-                    st.error(f"Error fetching triage result: {e}")
+        key = answers_hash(answers, l_key, fast_mode)
+        clicked = st.button("Get Triage Result / ഫലം ലഭിക്കുക", use_container_width=True)
+        data = memoized_results().get(key)
+        if clicked or data is not None:
+            level_box = st.empty()
+            reasoning_box = st.empty()
+            if data is None:
+                with st.spinner("Analyzing via Backend..."):
+                    try:
+                        data = fetch_triage({"answers": answers, "language": l_key}, level_box)
+                        remember_result(key, data)
+                    except Exception as e:
+                        st.error(f"Error fetching triage result: {e}")
+            if data is not None:
+                show_result(data, level_box, reasoning_box)
+                if data.get("reasoning_pending"):
+                    fetch_reasoning(key, data, reasoning_box)
+        st.session_state["_result_shown"] = data is not None
 
 st.divider()
 st.info("Disclaimer: This tool is for informational purposes only.")
+
+# Rerun counts and render times per interaction
+stats = diagnostics()
+stats["full_reruns"] += 1
+stats["last_full_ms"] = (time.perf_counter() - run_started) * 1000
+with st.sidebar.expander("Diagnostics"):
+    st.write(f"Section re-renders: {'on' if USE_FRAGMENTS else 'off (full page per answer)'}")
+    st.write(f"Full reruns: {stats['full_reruns']}, section reruns: {stats['section_reruns']}")
+    st.write(f"Last full render: {stats['last_full_ms']:.0f} ms, last section render: {stats['last_section_ms']:.0f} ms")
@@ -0,0 +1,47 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# -----------------------------
+# CONFIG
+# -----------------------------
+MAX_PENDING_ASSESSMENTS = int(os.environ.get("TRIAGE_MAX_PENDING_ASSESSMENTS", "1024"))
+ASSESSMENT_TTL_SECONDS = float(os.environ.get("TRIAGE_ASSESSMENT_TTL", "900"))
+
+# -----------------------------
+# DEFERRED REASONING STORE
+# -----------------------------
+class ReasoningStore:
+    """
+    Futures for reasoning that is generated after the triage level has been
+    returned, looked up by assessment id. Bounded and expiring, like ResultCache.
+    """
+
+    def __init__(self, max_size=MAX_PENDING_ASSESSMENTS, ttl_seconds=ASSESSMENT_TTL_SECONDS):
+        self.max_size = max(1, int(max_size))
+        self.ttl = ttl_seconds
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, future):
+        assessment_id = uuid.uuid4().hex
+        with self._lock:
+            self._data[assessment_id] = (time.monotonic(), future)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return assessment_id
+
+    def get(self, assessment_id):
+        with self._lock:
+            entry = self._data.get(assessment_id)
+            if entry is None:
+                return None
+            if self.ttl > 0 and time.monotonic() - entry[0] > self.ttl:
+                del self._data[assessment_id]
+                return None
+            return entry[1]
+
+    def __len__(self):
+        return len(self._data)
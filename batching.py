@@ -0,0 +1,202 @@
+import math
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from .logic import classify_batch, stream_classify
+
+# -----------------------------
+# CONFIG
+# -----------------------------
+MAX_BATCH_SIZE = int(os.environ.get("TRIAGE_MAX_BATCH_SIZE", "8"))
+MAX_WAIT_MS = float(os.environ.get("TRIAGE_MAX_WAIT_MS", "10"))
+# Requests waiting for the model beyond this are rejected with 503
+MAX_QUEUE_SIZE = int(os.environ.get("TRIAGE_MAX_QUEUE_SIZE", "64"))
+MODEL_WORKERS = int(os.environ.get("TRIAGE_MODEL_WORKERS", "1"))
+
+
+class InferenceQueueFull(Exception):
+    """Raised when the inference queue cannot take another request."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Job:
+    __slots__ = ("summary", "future", "on_chunk", "call")
+
+    def __init__(self, summary, on_chunk=None, call=None):
+        self.summary = summary
+        self.future = Future()
+        # Streaming jobs get every decoded chunk and run on their own
+        self.on_chunk = on_chunk
+        # Other model work (e.g. deferred reasoning) also runs on its own
+        self.call = call
+
+    @property
+    def solo(self):
+        return self.on_chunk is not None or self.call is not None
+
+
+# -----------------------------
+# DYNAMIC MICRO-BATCHING
+# -----------------------------
+class MicroBatcher:
+    """
+    Bounded inference queue served by dedicated model worker threads.
+    Each worker gathers classify() jobs for up to `max_wait_ms` and runs them
+    as one padded generate() call of at most `max_batch_size` prompts.
+    """
+
+    def __init__(self, batch_fn=classify_batch, stream_fn=stream_classify, max_batch_size=MAX_BATCH_SIZE,
+                 max_wait_ms=MAX_WAIT_MS, max_queue_size=MAX_QUEUE_SIZE, workers=MODEL_WORKERS):
+        self.batch_fn = batch_fn
+        self.stream_fn = stream_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.workers = max(1, int(workers))
+        self._queue = queue.Queue(maxsize=max(0, int(max_queue_size)))
+        self._lock = threading.Lock()
+        self._threads = []
+        self._in_flight = 0
+        self._processed = 0
+        self._rejected = 0
+        self._batches = 0
+        self._busy_seconds = 0.0
+
+    def start(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._run, name=f"triage-worker-{len(self._threads)}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _put(self, job, block, timeout):
+        self.start()
+        try:
+            self._queue.put(job, block=block, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise InferenceQueueFull(self.retry_after())
+        return job.future
+
+    def submit(self, summary_text, block=False, timeout=None):
+        """
+        Queue a summary and return a Future resolving to its parsed result.
+        Raises InferenceQueueFull if the queue has no room.
+        """
+        return self._put(_Job(summary_text), block, timeout)
+
+    def submit_stream(self, summary_text, on_chunk, block=False, timeout=None):
+        """
+        Queue a streaming generation; `on_chunk` is called from the worker
+        thread with each decoded chunk and the Future resolves to the full text.
+        """
+        return self._put(_Job(summary_text, on_chunk), block, timeout)
+
+    def submit_call(self, fn, *args, block=False, timeout=None):
+        """Queue arbitrary model work to run on a worker; returns its Future."""
+        return self._put(_Job(None, call=lambda: fn(*args)), block, timeout)
+
+    def classify(self, summary_text):
+        return self.submit(summary_text, block=True).result()
+
+    def retry_after(self):
+        """Rough seconds until the current backlog drains, for Retry-After."""
+        with self._lock:
+            per_batch = self._busy_seconds / self._batches if self._batches else 1.0
+        batches = math.ceil(self._queue.qsize() / (self.max_batch_size * self.workers))
+        return max(1, math.ceil(batches * per_batch))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "in_flight": self._in_flight,
+                "workers": self.workers,
+                "processed": self._processed,
+                "rejected": self._rejected,
+                "batches": self._batches,
+                "avg_batch_size": self._processed / self._batches if self._batches else 0.0,
+                "avg_batch_seconds": self._busy_seconds / self._batches if self._batches else 0.0,
+            }
+
+    def _collect(self, held):
+        batch = [held or self._queue.get()]
+        if batch[0].solo:
+            return batch, None
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    job = self._queue.get(timeout=remaining)
+                else:
+                    job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job.solo:
+                # Streaming and other solo jobs are not batched; run it right after this batch
+                return batch, job
+            batch.append(job)
+        return batch, None
+
+    def _run(self):
+        held = None
+        while True:
+            batch, held = self._collect(held)
+            # Drop callers that gave up while waiting in the queue
+            batch = [job for job in batch if job.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            with self._lock:
+                self._in_flight += len(batch)
+            started = time.monotonic()
+            try:
+                if batch[0].call is not None:
+                    self._run_call(batch[0])
+                elif batch[0].on_chunk is not None:
+                    self._run_stream(batch[0])
+                else:
+                    self._run_batch(batch)
+            finally:
+                with self._lock:
+                    self._in_flight -= len(batch)
+                    self._processed += len(batch)
+                    self._batches += 1
+                    self._busy_seconds += time.monotonic() - started
+
+    def _run_batch(self, batch):
+        try:
+            results = self.batch_fn([job.summary for job in batch])
+        except Exception as e:
+            for job in batch:
+                job.future.set_exception(e)
+            return
+        for job, res in zip(batch, results):
+            job.future.set_result(res)
+
+    def _run_stream(self, job):
+        text = ""
+        try:
+            for chunk in self.stream_fn(job.summary):
+                text += chunk
+                job.on_chunk(chunk)
+        except Exception as e:
+            job.future.set_exception(e)
+            return
+        job.future.set_result(text)
+
+    def _run_call(self, job):
+        try:
+            res = job.call()
+        except Exception as e:
+            job.future.set_exception(e)
+            return
+        job.future.set_result(res)
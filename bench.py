@@ -0,0 +1,242 @@
+import argparse
+import gc
+import json
+import os
+import time
+from collections import Counter
+
+from . import logic
+from transformers import AutoTokenizer
+
+from .logic import (
+    MODEL_NAME, CLASSIFY_PROMPT, ModelHolder, load_model, build_summary, build_prompt, classify_batch,
+    prompt_token_counts
+)
+from .logic import check_red_flags, walk_summary
+from .prompts import left_pad
+from .rules import red_flag_engine, encode_matrix, exhaustive_answers, sampled_answers
+from .table import enumerate_weighted
+
+
+def answer_corpus(size=100):
+    """Fixed evaluation corpus: the most probable non-red-flag answer sets."""
+    return list(enumerate_weighted(size))
+
+
+def process_rss_mb():
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def classify_corpus(corpus, batch_size=4, summary_mode=None):
+    """Run the corpus through classify_batch; returns (levels, seconds per item)."""
+    levels = []
+    started = time.perf_counter()
+    for i in range(0, len(corpus), batch_size):
+        chunk = corpus[i:i + batch_size]
+        levels += [res["triage_level"] for res in classify_batch([build_summary(a, summary_mode) for a in chunk])]
+    return levels, (time.perf_counter() - started) / max(1, len(corpus))
+
+
+# -----------------------------
+# PRECISION COMPARISON
+# -----------------------------
+def compare_precision(baseline="fp32", candidate="int8", size=100, batch_size=4):
+    """
+    Load the model once per CPU mode, triage the same fixed corpus with each
+    and report memory, latency and agreement of triage levels with `baseline`.
+    """
+    corpus = answer_corpus(size)
+    original = logic.model_holder
+    report = {"corpus_size": len(corpus), "modes": {}}
+    levels = {}
+    try:
+        for mode in (baseline, candidate):
+            holder = ModelHolder(loader=lambda mode=mode: load_model(mode))
+            logic.model_holder = holder
+            rss_before = process_rss_mb()
+            started = time.perf_counter()
+            holder.get()
+            load_seconds = time.perf_counter() - started
+            rss_loaded = process_rss_mb()
+            levels[mode], per_item = classify_corpus(corpus, batch_size)
+            report["modes"][mode] = {
+                "load_seconds": round(load_seconds, 1),
+                "model_rss_mb": round(rss_loaded - rss_before),
+                "seconds_per_assessment": round(per_item, 3),
+            }
+            holder.unload()
+            logic.clear_prefix_cache()
+            del holder
+            gc.collect()
+    finally:
+        logic.model_holder = original
+
+    pairs = list(zip(levels[baseline], levels[candidate]))
+    report["agreement"] = round(sum(a == b for a, b in pairs) / max(1, len(pairs)), 4)
+    report["confusion"] = {f"{a}->{b}": n for (a, b), n in sorted(Counter(pairs).items())}
+    print(json.dumps(report, indent=2))
+    return report
+
+
+# -----------------------------
+# SUMMARY MODE COMPARISON
+# -----------------------------
+def compare_summary_modes(size=100, batch_size=4):
+    """
+    Triage the same fixed corpus with verbose and compact summaries and report
+    prompt token counts per component, latency and agreement of triage levels.
+    """
+    corpus = answer_corpus(size)
+    report = {"corpus_size": len(corpus), "modes": {}}
+    levels = {}
+    for mode in ("verbose", "compact"):
+        counts = [prompt_token_counts(build_summary(a, mode)) for a in corpus]
+        levels[mode], per_item = classify_corpus(corpus, batch_size, mode)
+        report["modes"][mode] = {
+            "mean_prompt_tokens": {
+                part: round(sum(c[part] for c in counts) / max(1, len(counts)), 1) for part in counts[0]
+            } if counts else {},
+            "seconds_per_assessment": round(per_item, 3),
+        }
+
+    pairs = list(zip(levels["verbose"], levels["compact"]))
+    report["agreement"] = round(sum(a == b for a, b in pairs) / max(1, len(pairs)), 4)
+    report["confusion"] = {f"{a}->{b}": n for (a, b), n in sorted(Counter(pairs).items())}
+    print(json.dumps(report, indent=2))
+    return report
+
+
+# -----------------------------
+# PROMPT TOKENIZATION
+# -----------------------------
+def compare_prompt_tokenization(size=100, batch_size=4, repeats=20):
+    """
+    Time building padded input ids for the corpus by tokenizing the whole
+    prompt per call versus splicing the pre-tokenized template, and check
+    both give identical ids. Needs only the tokenizer.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    tokenizer.padding_side = "left"
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    summaries = [build_summary(a) for a in answer_corpus(size)]
+    batches = [summaries[i:i + batch_size] for i in range(0, len(summaries), batch_size)]
+    CLASSIFY_PROMPT.head_ids(tokenizer)  # fixed segments are tokenized once, up front
+
+    def per_call():
+        for batch in batches:
+            tokenizer([build_prompt(s) for s in batch], return_tensors="pt", padding=True)
+
+    def template():
+        for batch in batches:
+            left_pad(CLASSIFY_PROMPT.batch_ids(tokenizer, [{"summary": s} for s in batch]), pad_id)
+
+    report = {"corpus_size": len(summaries), "batch_size": batch_size}
+    for name, fn in (("per_call", per_call), ("template", template)):
+        started = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        report[f"{name}_ms_per_prompt"] = round((time.perf_counter() - started) * 1000 / (repeats * max(1, len(summaries))), 3)
+    report["speedup"] = round(report["per_call_ms_per_prompt"] / max(1e-9, report["template_ms_per_prompt"]), 2)
+    report["mismatches"] = sum(not CLASSIFY_PROMPT.matches_full_tokenization(tokenizer, summary=s) for s in summaries)
+    print(json.dumps(report, indent=2))
+    return report
+
+
+# -----------------------------
+# RED-FLAG RULES DIFFERENTIAL CHECK
+# -----------------------------
+def check_red_flag_rules(samples=100000, seed=0):
+    """
+    Compare the compiled red-flag rules with check_red_flags, for single
+    dicts and the vectorized batch path. The check covers every combination
+    of valid answers to the questions the rules reference, plus a random sample
+    that also includes unanswered questions and unexpected values.
+    """
+    engine = red_flag_engine
+    exhaustive = exhaustive_answers(engine)
+    sampled = sampled_answers(samples, seed)
+
+    ok = True
+    for name, corpus in (("exhaustive", exhaustive), ("sampled", sampled)):
+        started = time.perf_counter()
+        expected = [check_red_flags(a) for a in corpus]
+        reference_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        single = [engine.screen(a) for a in corpus]
+        single_seconds = time.perf_counter() - started
+
+        codes = encode_matrix(corpus)
+        started = time.perf_counter()
+        batch = engine.evaluate_matrix(codes) >= 0
+        batch_seconds = time.perf_counter() - started
+
+        single_mismatches = sum(e != s for e, s in zip(expected, single))
+        batch_mismatches = sum((e is not None) != bool(b) for e, b in zip(expected, batch.tolist()))
+        ok = ok and single_mismatches == 0 and batch_mismatches == 0
+        print(f"{name}: n={len(corpus)} red={sum(e is not None for e in expected)} "
+              f"mismatches single={single_mismatches} batch={batch_mismatches} | "
+              f"reference={reference_seconds * 1e6 / len(corpus):.2f}us/item "
+              f"compiled={single_seconds * 1e6 / len(corpus):.2f}us/item "
+              f"vectorized={batch_seconds * 1e6 / len(corpus):.3f}us/item (encoded)")
+    print("OK" if ok else "FAILED")
+    return ok
+
+
+# -----------------------------
+# SUMMARY BUILDER
+# -----------------------------
+def compare_summary_builders(size=1000, repeats=20):
+    """Time the compiled QUESTIONNAIRE summary against walking QUESTIONS, and check they agree."""
+    corpus = answer_corpus(size)
+    report = {"corpus_size": len(corpus)}
+    for name, fn in (("walk", walk_summary), ("compiled", build_summary)):
+        started = time.perf_counter()
+        for _ in range(repeats):
+            for answers in corpus:
+                fn(answers)
+        report[f"{name}_us_per_summary"] = round((time.perf_counter() - started) * 1e6 / (repeats * max(1, len(corpus))), 2)
+    report["speedup"] = round(report["walk_us_per_summary"] / max(1e-9, report["compiled_us_per_summary"]), 2)
+    report["mismatches"] = sum(walk_summary(a) != build_summary(a, "verbose") for a in corpus)
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks and consistency checks for the triage service.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    precision = sub.add_parser("precision", help="Compare triage agreement, memory and latency across CPU modes")
+    precision.add_argument("--baseline", default="fp32")
+    precision.add_argument("--candidate", default="int8")
+    precision.add_argument("--size", type=int, default=100)
+    precision.add_argument("--batch-size", type=int, default=4)
+    summary = sub.add_parser("summary", help="Compare verbose and compact summaries: tokens, latency, agreement")
+    summary.add_argument("--size", type=int, default=100)
+    summary.add_argument("--batch-size", type=int, default=4)
+    tokens = sub.add_parser("prompt-tokens", help="Per-call prompt tokenization vs pre-tokenized templates")
+    tokens.add_argument("--size", type=int, default=100)
+    tokens.add_argument("--batch-size", type=int, default=4)
+    tokens.add_argument("--repeats", type=int, default=20)
+    flags = sub.add_parser("red-flags", help="Compiled red-flag rules must match check_red_flags")
+    flags.add_argument("--samples", type=int, default=100000)
+    builder = sub.add_parser("summary-builder", help="Compiled questionnaire vs walking QUESTIONS for build_summary")
+    builder.add_argument("--size", type=int, default=1000)
+    builder.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "precision":
+        compare_precision(args.baseline, args.candidate, args.size, args.batch_size)
+    elif args.command == "summary":
+        compare_summary_modes(args.size, args.batch_size)
+    elif args.command == "prompt-tokens":
+        compare_prompt_tokenization(args.size, args.batch_size, args.repeats)
+    elif args.command == "red-flags":
+        raise SystemExit(0 if check_red_flag_rules(args.samples) else 1)
+    elif args.command == "summary-builder":
+        compare_summary_builders(args.size, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import time
+
+from .logic import QUESTIONNAIRE, HOME_ADVICE_LIBRARY, RED_FLAG_RESULT, model_signature
+from .rules import red_flag_engine
+from .table import DEFAULT_TABLE_PATH, load_table
+
+# -----------------------------
+# CONFIG
+# -----------------------------
+DEFAULT_BUNDLE_PATH = os.environ.get("TRIAGE_BUNDLE_PATH", "triage_bundle.json.gz")
+# Must match offline.BUNDLE_FORMAT / BUNDLE_VERSION
+BUNDLE_FORMAT = "gramcare-offline-bundle"
+BUNDLE_VERSION = 1
+
+# -----------------------------
+# EXPORT
+# -----------------------------
+def export_questions():
+    return [
+        {
+            "id": q.q_id,
+            "category": q.category,
+            "type": q.type,
+            "values": list(q.values),
+            "labels": q.labels,
+            "option_labels": {lang: list(labels) for lang, labels in q.option_labels.items()},
+            "is_critical": q.is_critical,
+        }
+        for q in QUESTIONNAIRE.questions
+    ]
+
+def export_rules(engine=red_flag_engine):
+    """Compiled red-flag tables: per question, clause bits for unanswered, each value and any other value."""
+    return {
+        "names": engine.names,
+        "rule_masks": engine.rule_masks,
+        "questions": [
+            {"id": QUESTIONNAIRE.questions[i].q_id, "unanswered": t[0], "values": t[1:-1], "other": t[-1]}
+            for i, t in zip(engine.indexes, engine.tables)
+        ],
+        "result": RED_FLAG_RESULT,
+    }
+
+def export_results(table):
+    """
+    Materialized results keyed by AnswerVector hash64 (hex), with reasoning
+    and confidence strings interned: [level, reasoning, confidence, advice keys].
+    """
+    strings, index, results = [], {}, {}
+
+    def intern(text):
+        if text not in index:
+            index[text] = len(strings)
+            strings.append(text)
+        return index[text]
+
+    for h, res in table.entries():
+        results[f"{h:016x}"] = [
+            res["triage_level"], intern(res["reasoning"]), intern(res["confidence"]), res["home_advice"]
+        ]
+    return {"model_signature": model_signature(), "strings": strings, "entries": results}
+
+def build_bundle(table=None):
+    bundle = {
+        "questions": export_questions(),
+        "red_flags": export_rules(),
+        "advice": HOME_ADVICE_LIBRARY,
+        "results": export_results(table) if table is not None else None,
+    }
+    content = json.dumps(bundle, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    bundle["format"] = BUNDLE_FORMAT
+    bundle["version"] = BUNDLE_VERSION
+    bundle["bundle_id"] = hashlib.blake2b(content, digest_size=8).hexdigest()
+    bundle["created"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    return bundle
+
+def write_bundle(path, bundle):
+    data = json.dumps(bundle, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    return os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the offline triage bundle for field devices.")
+    parser.add_argument("--out", default=DEFAULT_BUNDLE_PATH, help="Output bundle path")
+    parser.add_argument("--table", default=DEFAULT_TABLE_PATH, help="Materialized triage table to include")
+    parser.add_argument("--no-results", action="store_true", help="Only questions, rules and advice")
+    args = parser.parse_args()
+
+    table = None if args.no_results else load_table(args.table)
+    bundle = build_bundle(table)
+    size = write_bundle(args.out, bundle)
+    results = len(bundle["results"]["entries"]) if bundle["results"] else 0
+    print(f"Wrote bundle {bundle['bundle_id']} to {args.out}: {size} bytes, "
+          f"{len(bundle['red_flags']['names'])} red-flag rules, {results} materialized results")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# -----------------------------
+# CONFIG
+# -----------------------------
+CACHE_MAX_SIZE = int(os.environ.get("TRIAGE_CACHE_SIZE", "1024"))
+CACHE_TTL_SECONDS = float(os.environ.get("TRIAGE_CACHE_TTL", "3600"))
+
+# -----------------------------
+# LRU + TTL RESULT CACHE
+# -----------------------------
+class ResultCache:
+    """
+    Bounded, thread-safe LRU cache whose entries also expire after `ttl_seconds`.
+    Values are copied on the way in and out so callers can enrich them freely.
+    """
+
+    def __init__(self, max_size=CACHE_MAX_SIZE, ttl_seconds=CACHE_TTL_SECONDS):
+        self.max_size = max(0, int(max_size))
+        self.ttl = ttl_seconds
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (self.ttl > 0 and now - entry[0] > self.ttl):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, key, value):
+        if self.max_size == 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), dict(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,366 @@
+import re
+import threading
+from bisect import bisect_left
+from collections import deque
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+# -----------------------------
+# VOCABULARY INDEX
+# -----------------------------
+_BYTE_TOKEN = re.compile(r"^<0x([0-9A-Fa-f]{2})>$")
+_vocab_cache = {}
+
+
+class TokenVocab:
+    """
+    Surface strings for every token id, computed once per tokenizer.
+    Special/added tokens and partial UTF-8 byte tokens map to None.
+    """
+
+    def __init__(self, tokenizer):
+        self.eos_ids = set()
+        for eos in (tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<end_of_turn>")):
+            if isinstance(eos, int) and eos != tokenizer.unk_token_id:
+                self.eos_ids.add(eos)
+
+        special = set(getattr(tokenizer, "added_tokens_decoder", {}) or {}) | set(tokenizer.all_special_ids)
+        pieces = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        self.strings = []
+        for token_id, piece in enumerate(pieces):
+            text = None
+            if piece is not None and token_id not in special:
+                byte = _BYTE_TOKEN.match(piece)
+                if byte:
+                    code = int(byte.group(1), 16)
+                    text = chr(code) if code < 0x80 else None
+                else:
+                    text = piece.replace("▁", " ")
+            self.strings.append(text or None)
+
+        # Tokens sorted by surface string, so all tokens sharing a prefix are one slice
+        ordered = sorted((text, token_id) for token_id, text in enumerate(self.strings) if text)
+        self.sorted_texts = [text for text, _ in ordered]
+        self.sorted_ids = [token_id for _, token_id in ordered]
+        self._free_text = {}
+        # Allowed token ids per (shape, state, logits width, device), see shape_tokens()
+        self._shape_tokens = {}
+
+    def free_text_tensors(self, size, device):
+        """
+        Mask of tokens that can never end or break a JSON string, plus the
+        length of every token, padded to the model's logits width.
+        """
+        key = (size, str(device))
+        if key not in self._free_text:
+            strings = self.strings[:size] + [None] * (size - len(self.strings))
+            safe = torch.tensor([bool(t) and not (set(t) & _STRING_FORBIDDEN) for t in strings], device=device)
+            lengths = torch.tensor([len(t) if t else 0 for t in strings], device=device)
+            self._free_text[key] = (safe, lengths)
+        return self._free_text[key]
+
+    def matching_tokens(self, shape, state, prefix="", scan_limit=64):
+        """
+        Ids of tokens whose text, after `prefix`, keeps `state` inside `shape`.
+        Walks the sorted vocabulary one character at a time, following only
+        characters the shape accepts, and tests tokens one by one only once a
+        prefix narrows them down to `scan_limit` (or reaches free text).
+        """
+        found = []
+        stack = [(prefix, state)]
+        while stack:
+            text, current = stack.pop()
+            lo = bisect_left(self.sorted_texts, text)
+            hi = bisect_left(self.sorted_texts, text + "\U0010ffff", lo)
+            if lo == hi:
+                continue
+            if hi - lo <= scan_limit or shape.in_free_text(current):
+                for i in range(lo, hi):
+                    if shape.advance(current, self.sorted_texts[i][len(text):]) is not None:
+                        found.append(self.sorted_ids[i])
+                continue
+            while text and lo < hi and self.sorted_texts[lo] == text:
+                found.append(self.sorted_ids[lo])
+                lo += 1
+            for ch in shape.next_chars(current):
+                stack.append((text + ch, shape.step(current, ch)))
+        return found
+
+    def shape_tokens(self, shape, key, state, prefix, size, device):
+        """matching_tokens() as an id tensor, computed once per tokenizer for each key."""
+        cache_key = (shape.key, key, size, str(device))
+        ids = self._shape_tokens.get(cache_key)
+        if ids is None:
+            found = [i for i in self.matching_tokens(shape, state, prefix) if i < size]
+            ids = self._shape_tokens[cache_key] = torch.tensor(sorted(found), dtype=torch.long, device=device)
+        return ids
+
+    @classmethod
+    def for_tokenizer(cls, tokenizer):
+        vocab = _vocab_cache.get(id(tokenizer))
+        if vocab is None:
+            vocab = _vocab_cache[id(tokenizer)] = cls(tokenizer)
+        return vocab
+
+
+# -----------------------------
+# JSON SHAPE GRAMMAR
+# -----------------------------
+# Characters a JSON string may contain without escaping in our output
+_STRING_FORBIDDEN = set('"\\\n\r\t') | {chr(c) for c in range(0x20)}
+# Characters JsonShape outside free text can consist of
+_CANDIDATE_CHARS = [chr(c) for c in range(0x20, 0x7F)] + ["\n"]
+
+
+class JsonShape:
+    """
+    Character-level automaton for the exact classify() output:
+
+        {"triage_level": "<level>", "reasoning": "<text>",
+         "confidence": "<High|Medium|Low>", "home_advice": ["<KEY>", ...]}
+
+    laid out the way the prompt's return format shows it. States are small
+    tuples so they can be stepped per candidate token cheaply.
+    """
+
+    def __init__(self, levels, advice_keys, confidences=("High", "Medium", "Low"),
+                 max_reasoning_chars=600, max_advice=3):
+        self.segments = [
+            ("lit", '{\n  "triage_level": "'),
+            ("enum", tuple(sorted(levels))),
+            ("lit", '",\n  "reasoning": "'),
+            ("str", max_reasoning_chars),
+            ("lit", '",\n  "confidence": "'),
+            ("enum", tuple(confidences)),
+            ("lit", '",\n  "home_advice": ['),
+            ("list", tuple(sorted(advice_keys)), max_advice),
+            ("lit", "]\n}"),
+        ]
+        self.start = (0, "")
+        # Identifies the grammar in per-tokenizer caches
+        self.key = tuple(self.segments)
+
+    def is_complete(self, state):
+        return state[0] == len(self.segments)
+
+    def in_free_text(self, state):
+        return state[0] < len(self.segments) and self.segments[state[0]][0] == "str"
+
+    def free_text_left(self, state):
+        return self.segments[state[0]][1] - len(state[1])
+
+    def step(self, state, ch):
+        """Advance by one character; returns the new state or None if invalid."""
+        seg, buf = state
+        if seg >= len(self.segments):
+            return None
+        kind = self.segments[seg][0]
+
+        if kind == "lit":
+            text = self.segments[seg][1]
+            if text[len(buf)] != ch:
+                return None
+            buf += ch
+            return (seg + 1, "") if buf == text else (seg, buf)
+
+        if kind == "enum":
+            options = self.segments[seg][1]
+            if any(o.startswith(buf + ch) for o in options):
+                return (seg, buf + ch)
+            if buf in options:
+                return self.step((seg + 1, ""), ch)
+            return None
+
+        if kind == "str":
+            if ch == '"':
+                return self.step((seg + 1, ""), ch)
+            if ch in _STRING_FORBIDDEN or len(buf) >= self.segments[seg][1]:
+                return None
+            return (seg, buf + ch)
+
+        # "list": buf is (chosen keys, phase, partial key)
+        options, max_items = self.segments[seg][1], self.segments[seg][2]
+        chosen, phase, partial = buf or ((), "start", "")
+        if phase in ("start", "open"):
+            if ch == '"':
+                return (seg, (chosen, "key", ""))
+            # Only an empty list may close straight after "["
+            return self.step((seg + 1, ""), ch) if phase == "start" else None
+        if phase == "key":
+            if ch == '"':
+                if partial in options and partial not in chosen:
+                    return (seg, (chosen + (partial,), "after", ""))
+                return None
+            partial += ch
+            if any(o.startswith(partial) for o in options if o not in chosen):
+                return (seg, (chosen, "key", partial))
+            return None
+        if phase == "after":
+            if ch == ",":
+                return (seg, (chosen, "comma", "")) if len(chosen) < max_items else None
+            return self.step((seg + 1, ""), ch)
+        # phase == "comma"
+        return (seg, (chosen, "open", "")) if ch == " " else None
+
+    def next_chars(self, state):
+        """Characters the shape accepts next (printable ASCII and newline)."""
+        return [ch for ch in _CANDIDATE_CHARS if self.step(state, ch) is not None]
+
+    def advance(self, state, text):
+        for ch in text:
+            state = self.step(state, ch)
+            if state is None:
+                return None
+        return state
+
+
+# -----------------------------
+# LOGITS PROCESSOR
+# -----------------------------
+class JsonShapeLogitsProcessor(LogitsProcessor):
+    """
+    Masks every token that would take a row's output outside JsonShape,
+    and forces EOS once the object is complete. Rows are tracked
+    incrementally, so each step only decodes the newest token.
+    """
+
+    def __init__(self, tokenizer, shape):
+        self.vocab = TokenVocab.for_tokenizer(tokenizer)
+        self.shape = shape
+        self.prompt_len = None
+        self.states = None
+
+    def _allowed(self, state, size, device):
+        mask = torch.zeros(size, dtype=torch.bool, device=device)
+        if state is None:
+            mask.fill_(True)
+            return mask
+        if self.shape.is_complete(state):
+            mask[[i for i in self.vocab.eos_ids if i < size]] = True
+            return mask
+
+        if self.shape.in_free_text(state):
+            left = self.shape.free_text_left(state)
+            if left > 0:
+                safe, lengths = self.vocab.free_text_tensors(size, device)
+                # Only tokens short enough to fit in the remaining budget
+                mask |= safe & (lengths <= left)
+            # Tokens closing the string do not depend on the text so far
+            closing = self.shape.step(state, '"')
+            ok = self.vocab.shape_tokens(self.shape, ("close", state[0]), closing, '"', size, device)
+        else:
+            # Literal, enum and list positions form a small fixed set of states
+            ok = self.vocab.shape_tokens(self.shape, state, state, "", size, device)
+        mask[ok] = True
+        return mask
+
+    def __call__(self, input_ids, scores):
+        batch, size = scores.shape
+        if self.states is None:
+            self.prompt_len = input_ids.shape[-1]
+            self.states = [self.shape.start] * batch
+        elif input_ids.shape[-1] > self.prompt_len:
+            for row in range(batch):
+                state = self.states[row]
+                if state is None or self.shape.is_complete(state):
+                    continue
+                text = self.vocab.strings[input_ids[row, -1].item()]
+                self.states[row] = self.shape.advance(state, text) if text else None
+
+        for row in range(batch):
+            allowed = self._allowed(self.states[row], size, scores.device)
+            scores[row] = scores[row].masked_fill(~allowed, float("-inf"))
+        return scores
+
+
+# -----------------------------
+# EARLY STOPPING
+# -----------------------------
+class JsonObjectStoppingCriteria(StoppingCriteria):
+    """
+    Stops each row as soon as its first top-level JSON object closes (or,
+    with `stop_at_string_end`, as soon as the string open at the start ends).
+    Brace balance is tracked incrementally on the newest token only and
+    ignores braces inside JSON strings.
+    """
+
+    def __init__(self, tokenizer, depth=0, in_string=False, stop_at_string_end=False):
+        self.vocab = TokenVocab.for_tokenizer(tokenizer)
+        self.prompt_len = None
+        # Where a forced answer prefix left off, e.g. inside an open string
+        self.initial = (depth, in_string)
+        # Stop when the string that was open at the start closes instead
+        self.stop_at_string_end = stop_at_string_end
+        # Per row: [depth, in_string, escaped, generated length when closed]
+        self.rows = None
+
+    def closed_lengths(self):
+        """Generated token count at which each row closed its object (None if it never did)."""
+        return [row[3] for row in self.rows] if self.rows else []
+
+    def __call__(self, input_ids, scores, **kwargs):
+        batch = input_ids.shape[0]
+        if self.rows is None:
+            # Called after the first new token has been appended
+            self.prompt_len = input_ids.shape[-1] - 1
+            self.rows = [[self.initial[0], self.initial[1], False, None] for _ in range(batch)]
+        generated = input_ids.shape[-1] - self.prompt_len
+
+        for i, row in enumerate(self.rows):
+            if row[3] is not None:
+                continue
+            text = self.vocab.strings[input_ids[i, -1].item()] or ""
+            depth, in_string, escaped = row[0], row[1], row[2]
+            for ch in text:
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif ch == "\\":
+                        escaped = True
+                    elif ch == '"':
+                        in_string = False
+                        if self.stop_at_string_end:
+                            row[3] = generated
+                            break
+                elif ch == '"' and depth > 0:
+                    in_string = True
+                elif ch == "{":
+                    depth += 1
+                elif ch == "}" and depth > 0:
+                    depth -= 1
+                    if depth == 0:
+                        row[3] = generated
+                        break
+            row[0], row[1], row[2] = depth, in_string, escaped
+
+        return torch.tensor([row[3] is not None for row in self.rows], dtype=torch.bool, device=input_ids.device)
+
+
+class OutputLengthTracker:
+    """
+    Keeps recent classify() output lengths and derives a max_new_tokens budget
+    from a high percentile of them, with headroom, between `floor` and `ceiling`.
+    """
+
+    def __init__(self, ceiling, floor=64, percentile=99, headroom=1.25, window=512, min_samples=20):
+        self.ceiling = ceiling
+        self.floor = min(floor, ceiling)
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self._lengths = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, length):
+        with self._lock:
+            self._lengths.append(length)
+
+    def max_new_tokens(self):
+        with self._lock:
+            if len(self._lengths) < self.min_samples:
+                return self.ceiling
+            ordered = sorted(self._lengths)
+        rank = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        budget = int(ordered[rank] * self.headroom) + 1
+        return max(self.floor, min(self.ceiling, budget))
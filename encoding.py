@@ -0,0 +1,119 @@
+import hashlib
+from array import array
+
+from .logic import QUESTIONNAIRE, answers_cache_key, model_signature
+
+# -----------------------------
+# QUESTION CODEBOOK
+# -----------------------------
+# Per question, in QUESTIONS order: 0 = not answered, 1..n = the n valid
+# values in order, n + 1 = any other value
+CODEBOOK = [(q.q_id, list(q.values)) for q in QUESTIONNAIRE.questions]
+QUESTION_INDEX = {q_id: i for i, (q_id, _) in enumerate(CODEBOOK)}
+_CODES = [{v: i + 1 for i, v in enumerate(values)} for _, values in CODEBOOK]
+# Values matched the way answers_cache_key renders them, so 8 and "8" agree
+_CODES_BY_STR = [{str(v): i + 1 for i, v in enumerate(values)} for _, values in CODEBOOK]
+
+def encode_value(index, value):
+    """Code of an exact answer value; unknown values get the "other" code."""
+    if value is None:
+        return 0
+    try:
+        return _CODES[index].get(value, len(CODEBOOK[index][1]) + 1)
+    except TypeError:
+        return len(CODEBOOK[index][1]) + 1
+
+def encode_answers(answers):
+    """One small integer code per question, in QUESTIONS order."""
+    if isinstance(answers, AnswerVector):
+        return answers.codes
+    return [encode_value(i, answers.get(q_id)) for i, (q_id, _) in enumerate(CODEBOOK)]
+
+# -----------------------------
+# ANSWER VECTOR
+# -----------------------------
+class AnswerVector:
+    """
+    Fixed-width form of an answers dict: one byte per question holding its
+    code. Hashes and compares by those bytes, and reads like a dict through
+    get(), so it can stand in for answers in build_summary and rule checks.
+    Only answers made of valid values (or left unanswered) can be encoded.
+    """
+    __slots__ = ("codes", "_hash")
+
+    def __init__(self, codes):
+        codes = codes if isinstance(codes, array) else array("B", codes)
+        if len(codes) != len(CODEBOOK):
+            raise ValueError(f"Expected {len(CODEBOOK)} codes, got {len(codes)}")
+        for code, (_, values) in zip(codes, CODEBOOK):
+            if code > len(values):
+                raise ValueError("Answer code out of range")
+        self.codes = codes
+        self._hash = None
+
+    @classmethod
+    def from_dict(cls, answers):
+        codes = array("B", bytes(len(CODEBOOK)))
+        for i, (q_id, _) in enumerate(CODEBOOK):
+            value = answers.get(q_id)
+            if value is None:
+                continue
+            code = _CODES_BY_STR[i].get(str(value))
+            if code is None:
+                raise ValueError(f"{value!r} is not an answer to {q_id}")
+            codes[i] = code
+        vector = cls.__new__(cls)
+        vector.codes = codes
+        vector._hash = None
+        return vector
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(array("B", data))
+
+    def to_bytes(self):
+        return self.codes.tobytes()
+
+    def to_dict(self):
+        return {q_id: values[code - 1] for code, (q_id, values) in zip(self.codes, CODEBOOK) if code}
+
+    def get(self, q_id, default=None):
+        index = QUESTION_INDEX.get(q_id)
+        if index is None or not self.codes[index]:
+            return default
+        return CODEBOOK[index][1][self.codes[index] - 1]
+
+    def hash64(self):
+        """Stable 64-bit hash of the codes, the same across processes and runs."""
+        digest = hashlib.blake2b(self.codes.tobytes(), digest_size=8, person=b"answer-vector-v1").digest()
+        return int.from_bytes(digest, "little")
+
+    def __eq__(self, other):
+        if not isinstance(other, AnswerVector):
+            return NotImplemented
+        return self.codes == other.codes
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.codes.tobytes())
+        return self._hash
+
+    def __repr__(self):
+        return f"AnswerVector({self.to_dict()!r})"
+
+
+def answer_vector(answers):
+    """AnswerVector for an answers dict, or None if it holds values outside the options."""
+    if isinstance(answers, AnswerVector):
+        return answers
+    try:
+        return AnswerVector.from_dict(answers)
+    except ValueError:
+        return None
+
+def answers_key(answers):
+    """Result-cache key: the AnswerVector when the answers encode, else answers_cache_key."""
+    vector = answer_vector(answers)
+    if vector is None:
+        return answers_cache_key(answers)
+    return (model_signature(), vector)
@@ -1,31 +1,230 @@
+import os
+import re
+import logging
+import copy
+import threading
+import time
+from contextlib import contextmanager
 import torch
 import json
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, DynamicCache, LogitsProcessorList, StoppingCriteriaList,
+    TextIteratorStreamer
+)
+from .decoding import JsonShape, JsonShapeLogitsProcessor, JsonObjectStoppingCriteria, OutputLengthTracker
+from .prompts import Slot, register_prompt, left_pad
+from .metrics import GENERATIONS_IN_FLIGHT, PARSE_FALLBACKS, record_generation
+
+logger = logging.getLogger(__name__)
 
 # -----------------------------
 # CONFIG & MODEL LOADING
 # -----------------------------
 MODEL_NAME = "google/medgemma-4b-it"
 device = "cuda" if torch.cuda.is_available() else "cpu"
+# Reuse the KV cache of the fixed classify() prompt preamble across requests
+USE_PREFIX_CACHE = os.environ.get("TRIAGE_PREFIX_CACHE", "1") != "0"
+# Constrain classify() output to the exact JSON shape while decoding
+CONSTRAINED_DECODING = os.environ.get("TRIAGE_CONSTRAINED_DECODING", "0") == "1"
+# "generate" decodes the full JSON answer; "score" reads the triage level
+# straight from the label logits in a single forward pass
+CLASSIFY_MODE = os.environ.get("TRIAGE_CLASSIFY_MODE", "generate").lower()
+# "verbose" renders every answer as a sentence; "compact" lists only
+# abnormal or positive findings in terse form, for a shorter prefill
+SUMMARY_MODE = os.environ.get("TRIAGE_SUMMARY_MODE", "verbose").lower()
+# Derive max_new_tokens from observed output lengths instead of a fixed 400
+ADAPTIVE_MAX_NEW_TOKENS = os.environ.get("TRIAGE_ADAPTIVE_MAX_TOKENS", "1") != "0"
+# CPU inference precision: "auto", "bf16", "fp32" or "int8" (dynamic quantization of Linear layers)
+CPU_MODE = os.environ.get("TRIAGE_CPU_MODE", "auto").lower()
+# Memory the model may use, in GB; defaults to the RAM available at startup
+MEMORY_BUDGET_GB = float(os.environ.get("TRIAGE_MEMORY_BUDGET_GB", "0"))
+# generate() calls allowed to run at once. One is right for CPU boxes: torch
+# already spreads a single call across all cores, and concurrency comes from
+# batching requests into that call instead.
+MAX_CONCURRENT_GENERATIONS = int(os.environ.get("TRIAGE_MAX_CONCURRENT_GENERATIONS", "1"))
+
+# Rough weight sizes for MedGemma 4B, used to fit a precision into the budget
+MODEL_PARAMS = 4.3e9
+# Embedding parameters are not Linear, so they stay fp32 in int8 mode
+EMBEDDING_PARAMS = 0.67e9
+# Extra room for activations, KV cache and allocator slack
+LOAD_HEADROOM = 1.15
+
+def cpu_supports_bf16():
+    """True if the CPU has native bf16 matmul instructions (AVX512-BF16 / AMX)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+def available_memory_bytes():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+def estimate_model_bytes(precision):
+    """(peak while loading, resident after loading) in bytes for a precision."""
+    if precision == "fp32":
+        size = MODEL_PARAMS * 4
+        return size * LOAD_HEADROOM, size * LOAD_HEADROOM
+    if precision in ("bf16", "fp16"):
+        size = MODEL_PARAMS * 2
+        return size * LOAD_HEADROOM, size * LOAD_HEADROOM
+    # int8 is loaded in bf16 and quantized one Linear layer at a time
+    size = (MODEL_PARAMS - EMBEDDING_PARAMS) + EMBEDDING_PARAMS * 4
+    return max(MODEL_PARAMS * 2, size) * LOAD_HEADROOM, size * LOAD_HEADROOM
+
+def plan_model_load(cpu_mode=None, budget_bytes=None):
+    """
+    Pick the precision to load with. On CPU, "auto" prefers bf16 when the CPU
+    supports it natively, then fp32, then int8, taking the first whose peak
+    load size fits the memory budget (TRIAGE_MEMORY_BUDGET_GB, else the RAM
+    currently available); int8 is the last resort. An explicit mode is
+    honoured even if it does not fit.
+    """
+    if device == "cuda":
+        return {"precision": "fp16", "torch_dtype": torch.float16, "device_map": "auto"}
 
-def load_model():
+    mode = cpu_mode or CPU_MODE
+    if budget_bytes is None:
+        budget_bytes = MEMORY_BUDGET_GB * 2**30 if MEMORY_BUDGET_GB else available_memory_bytes()
+    if mode == "auto":
+        candidates = (["bf16"] if cpu_supports_bf16() else []) + ["fp32", "int8"]
+        fitting = [p for p in candidates if estimate_model_bytes(p)[0] <= budget_bytes]
+        if not fitting:
+            logger.warning("No precision fits the %.1f GB memory budget; using int8", budget_bytes / 2**30)
+        precision = fitting[0] if fitting else "int8"
+    else:
+        precision = mode
+        if estimate_model_bytes(precision)[0] > budget_bytes:
+            logger.warning("TRIAGE_CPU_MODE=%s may not fit the %.1f GB memory budget", precision, budget_bytes / 2**30)
+
+    peak, resident = estimate_model_bytes(precision)
+    return {
+        "precision": precision,
+        "torch_dtype": torch.bfloat16 if precision in ("bf16", "int8") else torch.float32,
+        "device_map": {"": "cpu"},
+        "budget_gb": round(budget_bytes / 2**30, 1),
+        "estimated_peak_gb": round(peak / 2**30, 1),
+        "estimated_resident_gb": round(resident / 2**30, 1),
+    }
+
+# Decided once per process, before the model takes up memory
+_load_plan = None
+
+def current_load_plan():
+    global _load_plan
+    if _load_plan is None:
+        _load_plan = plan_model_load()
+    return _load_plan
+
+def model_precision(cpu_mode=None):
+    return plan_model_load(cpu_mode)["precision"] if cpu_mode else current_load_plan()["precision"]
+
+def configured_precision():
+    """Precision as configured ("fp16" on GPU, else TRIAGE_CPU_MODE), before any memory-based choice."""
+    return "fp16" if device == "cuda" else CPU_MODE
+
+def quantize_linear_int8(model):
+    """
+    Swap every nn.Linear for a dynamic int8 one, one layer at a time, so only
+    a single layer is ever held in fp32. Remaining weights are cast to fp32.
+    """
+    linears = [name for name, m in model.named_modules() if isinstance(m, torch.nn.Linear)]
+    for name in linears:
+        parent_name, _, child = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        wrapped = torch.nn.Sequential(getattr(parent, child).float())
+        wrapped = torch.ao.quantization.quantize_dynamic(wrapped, {torch.nn.Linear}, dtype=torch.qint8)
+        setattr(parent, child, wrapped[0])
+    return model.float()
+
+def load_model(cpu_mode=None):
     tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    plan = plan_model_load(cpu_mode) if cpu_mode else current_load_plan()
+    logger.info("Loading %s with plan %s", MODEL_NAME, plan)
+    # low_cpu_mem_usage loads weights straight into the target dtype, so
+    # startup does not briefly hold a second full-size copy of the model
     model = AutoModelForCausalLM.from_pretrained(
         MODEL_NAME,
-        torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-        device_map="auto"
+        torch_dtype=plan["torch_dtype"],
+        device_map=plan["device_map"],
+        low_cpu_mem_usage=True
     )
+    if plan["precision"] == "int8":
+        # Dynamic int8: Linear weights stored as int8, activations quantized per call
+        model = quantize_linear_int8(model)
+    model.eval()
+    # Left padding so batched prompts all end right where generation starts
+    tokenizer.padding_side = "left"
     return tokenizer, model
 
-# Global instances (initialized on first use or app start)
-tokenizer = None
-model = None
+class ModelHolder:
+    """
+    Owns the tokenizer/model pair for the process.
+
+    - Loading is single-flight: concurrent first callers wait for one load.
+    - acquire() hands out a reference-counted generation slot; at most
+      `max_concurrent` generate() calls run at once and the model cannot be
+      unloaded while any slot is held.
+    """
+
+    def __init__(self, loader=None, max_concurrent=MAX_CONCURRENT_GENERATIONS):
+        self._loader = loader or load_model
+        self._load_lock = threading.Lock()
+        self._ref_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrent))
+        self._pair = None
+        self.refs = 0
+        self.loads = 0
+
+    @property
+    def loaded(self):
+        return self._pair is not None
+
+    def get(self):
+        pair = self._pair
+        if pair is None:
+            with self._load_lock:
+                if self._pair is None:
+                    self._pair = self._loader()
+                    self.loads += 1
+                pair = self._pair
+        return pair
+
+    @contextmanager
+    def acquire(self):
+        """Hold a generation slot and a reference to the loaded model."""
+        with self._slots:
+            with self._ref_lock:
+                self.refs += 1
+            try:
+                yield self.get()
+            finally:
+                with self._ref_lock:
+                    self.refs -= 1
+
+    def unload(self):
+        """Drop the model if nobody holds it; returns whether it was dropped."""
+        with self._load_lock, self._ref_lock:
+            if self.refs:
+                return False
+            self._pair = None
+            return True
+
+# Process-wide model instance (loaded on first use or app start)
+model_holder = ModelHolder()
+GENERATIONS_IN_FLIGHT.set_function(lambda: model_holder.refs)
 
 def get_model():
-    global tokenizer, model
-    if tokenizer is None or model is None:
-        tokenizer, model = load_model()
-    return tokenizer, model
+    return model_holder.get()
 
 # -----------------------------
 # DATA STRUCTURES
@@ -331,13 +530,19 @@ HOME_ADVICE_LIBRARY = {
 # -----------------------------
 # HARD RED FLAG CHECK
 # -----------------------------
+RED_FLAG_RESULT = {
+    "triage_level": "RED",
+    "reasoning": "Immediate medical attention required for life-threatening symptoms flagged by critical clinical rules.",
+    "confidence": "High (Rule-based Override)",
+    "home_advice": []
+}
+
 def check_red_flags(answers):
-    critical_data = {
-        "triage_level": "RED",
-        "reasoning": "Immediate medical attention required for life-threatening symptoms flagged by critical clinical rules.",
-        "confidence": "High (Rule-based Override)",
-        "home_advice": []
-    }
+    """
+    Reference implementation of the red-flag rules. The service screens with
+    the compiled rules.RED_FLAG_RULES, which must agree with this function.
+    """
+    critical_data = dict(RED_FLAG_RESULT)
     
     # Rule 1: Direct Critical Questions (Q21, Q22, Q23)
     if any(answers.get(q) == "Yes" for q in ["Q21", "Q22", "Q23"]):
@@ -375,7 +580,43 @@ def check_red_flags(answers):
 # -----------------------------
 # BUILD STRUCTURED SUMMARY 
 # -----------------------------
-def build_summary(answers):
+# Terse wording for compact summaries. Only answers listed here are
+# mentioned; every other answer is a normal finding and is left out.
+COMPACT_FINDINGS = {
+    "Q1": lambda v: f"age {v}y",
+    "Q2": {"< 1 day": "onset <24h", "1–2 days": "duration 1-2d", "3+ days": "duration >3d"},
+    "Q3": {"Yes": "drowsy/confused/not responding normally"},
+    "Q4": {"No": "cannot drink or keep fluids down"},
+    "Q5": {"Yes": "chronic illness (asthma/diabetes/heart)"},
+    "Q6": {
+        "Warm but child active": "mild fever, active",
+        "Hot and uncomfortable": "moderate fever",
+        "Very hot and child weak": "high fever, child weak"
+    },
+    "Q7": {"Yes": "fever >3d"},
+    "Q8": {"Yes": "rash"},
+    "Q9": {"Yes": "neck stiffness"},
+    "Q10": {"1-3": "vomited 1-3x/24h", "4+": "vomited 4+x/24h"},
+    "Q11": {"Yes": "blood in vomit/stool"},
+    "Q12": {"Yes": "severe constant abdominal pain"},
+    "Q13": {"No": "no urine >8h"},
+    "Q14": {"Yes": "fast breathing"},
+    "Q15": {"Yes": "chest indrawing"},
+    "Q16": {"Yes": "cyanosis (lips/face bluish)"},
+    "Q17": {"Yes": "too breathless for full sentences"},
+    "Q18": {"Yes": "severe headache/body pain"},
+    "Q19": {"Yes": "recent head injury"},
+    "Q20": {"Yes": "repeated vomiting with headache"},
+    "Q21": {"Yes": "seizure"},
+    "Q22": {"Yes": "fainted/unconscious"},
+    "Q23": {"Yes": "severe injury/heavy bleeding"},
+}
+
+def walk_summary(answers):
+    """
+    Reference verbose summary, built by walking QUESTIONS. The service uses
+    the compiled QUESTIONNAIRE, which must render exactly the same text.
+    """
     summary = "Pediatric Clinical Assessment (Age 6-12):\n"
     for cat, qs in QUESTIONS.items():
         cat_summary = ""
@@ -398,6 +639,138 @@ def build_summary(answers):
             summary += f"\n### {cat}\n{cat_summary}"
     return summary
 
+# -----------------------------
+# COMPILED QUESTIONNAIRE
+# -----------------------------
+SUMMARY_HEADER = "Pediatric Clinical Assessment (Age 6-12):\n"
+LANGUAGES = ("en", "ml")
+
+class Question:
+    """One flattened QUESTIONS entry with its per-value text precomputed."""
+    __slots__ = (
+        "index", "q_id", "category", "type", "values", "labels", "option_labels", "min", "max",
+        "is_critical", "_lines", "_context", "_compact", "_compact_fn"
+    )
+
+    def __init__(self, index, category, q_id, q_data):
+        self.index = index
+        self.q_id = q_id
+        self.category = category
+        self.type = q_data["type"]
+        self.min = q_data.get("min")
+        self.max = q_data.get("max")
+        self.is_critical = bool(q_data.get("is_critical"))
+        options = q_data.get("options", {})
+        if self.type == "number":
+            self.values = tuple(range(self.min, self.max + 1))
+        else:
+            self.values = tuple(options)
+        self.labels = {lang: q_data.get(lang, q_data["en"]) for lang in LANGUAGES}
+        self.option_labels = {
+            lang: tuple(options[v].get(lang, v) for v in self.values) if options else ()
+            for lang in LANGUAGES
+        }
+
+        # Summary line for every value the context knows, rendered once
+        context = q_data.get("context")
+        self._context = context if callable(context) else None
+        if callable(context):
+            self._lines = {v: f"- {context(v)}\n" for v in self.values}
+        elif isinstance(context, dict):
+            self._lines = {v: f"- {desc}\n" for v, desc in context.items()}
+        else:
+            self._lines = {}
+
+        terse = COMPACT_FINDINGS.get(q_id, {})
+        self._compact_fn = terse if callable(terse) else None
+        self._compact = {} if callable(terse) else dict(terse)
+
+    def summary_line(self, value):
+        # Exact types only: 8.0 hashes like 8 but renders differently
+        line = self._lines.get(value) if type(value) in (str, int) else None
+        if line is None:
+            desc = self._context(value) if self._context else f"{self.labels['en']}: {value}"
+            line = f"- {desc}\n"
+        return line
+
+    def compact_finding(self, value):
+        """Terse phrase for an abnormal answer, or None for a normal one."""
+        if self._compact_fn:
+            return self._compact_fn(value)
+        finding = self._compact.get(value)
+        if finding is None and self.type == "radio" and value not in self.values:
+            # Unexpected value: keep it rather than silently reading it as normal
+            finding = f"{self.labels['en']} {value}"
+        return finding
+
+
+class Questionnaire:
+    """
+    QUESTIONS compiled once at import: flat, indexed Question records grouped
+    by category, with summary lines, compact findings and labels precomputed.
+    """
+
+    def __init__(self, questions):
+        self.questions = []
+        self.categories = []
+        for category, qs in questions.items():
+            records = []
+            for q_id, q_data in qs.items():
+                records.append(Question(len(self.questions), category, q_id, q_data))
+                self.questions.append(records[-1])
+            self.categories.append((category, f"\n### {category}\n", records))
+        self.by_id = {q.q_id: q for q in self.questions}
+
+    def summary(self, answers):
+        """Verbose summary, identical to walk_summary, built with a single join."""
+        parts = [SUMMARY_HEADER]
+        for _, header, records in self.categories:
+            lines = [q.summary_line(v) for q in records if (v := answers.get(q.q_id)) is not None]
+            if lines:
+                parts.append(header)
+                parts += lines
+        return "".join(parts)
+
+    def compact_summary(self, answers):
+        findings = []
+        unanswered = False
+        for q in self.questions:
+            value = answers.get(q.q_id)
+            if value is None:
+                unanswered = True
+            else:
+                finding = q.compact_finding(value)
+                if finding:
+                    findings.append(finding)
+        # Only answered questions may be read as normal
+        closing = (
+            "Other answered findings normal; unanswered questions not assessed.\n" if unanswered
+            else "All other screened findings normal.\n"
+        )
+        return f"{SUMMARY_HEADER}Findings: {'; '.join(findings) or 'none'}\n{closing}"
+
+
+QUESTIONNAIRE = Questionnaire(QUESTIONS)
+
+def build_summary(answers, mode=None):
+    if (mode or SUMMARY_MODE) == "compact":
+        return QUESTIONNAIRE.compact_summary(answers)
+    return QUESTIONNAIRE.summary(answers)
+
+def answers_cache_key(answers):
+    """
+    Canonical, hashable key for a set of answers. Only questions that reach
+    the summary are included, in QUESTIONS order, and values are encoded the
+    way build_summary renders them, so equivalent requests share one key.
+    """
+    encoded = tuple(
+        (q_id, str(answers[q_id]))
+        for qs in QUESTIONS.values()
+        for q_id in qs
+        if answers.get(q_id) is not None
+    )
+    return (model_signature(), encoded)
+
 # -----------------------------
 # MEDGEMMA CLASSIFICATION & EXTRACTION
 # -----------------------------
@@ -415,6 +788,7 @@ VALID_TRIAGE = {"RED", "YELLOW", "GREEN"}
 def extract_json_response(response_text: str):
     """
     Safely extract first valid JSON object using balanced brace counting.
+    Braces inside JSON strings (e.g. in the reasoning) are not counted.
     """
     # 1️⃣ Remove markdown wrappers if present
     cleaned = response_text.strip()
@@ -426,10 +800,22 @@ def extract_json_response(response_text: str):
         raise ValueError("No JSON object found")
 
     brace_count = 0
+    in_string = escaped = False
     for i in range(start, len(cleaned)):
-        if cleaned[i] == "{":
+        ch = cleaned[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch == "{":
             brace_count += 1
-        elif cleaned[i] == "}":
+        elif ch == "}":
             brace_count -= 1
 
         if brace_count == 0:
@@ -440,9 +826,30 @@ def extract_json_response(response_text: str):
 
     return json.loads(json_str)
 
-def classify(summary_text):
-    tokenizer, model = get_model()
-    prompt = f"""<start_of_turn>user
+CLASSIFY_MAX_NEW_TOKENS = 400
+# Bump whenever the classify prompt or its decoding settings change, so cached
+# results produced by the old prompt are not served for the new one.
+PROMPT_VERSION = 2
+PARSE_FALLBACK_REASONING = "AI analysis error. Precautionary triage applied."
+
+def model_signature():
+    """
+    Everything that determines classify() output for a given summary.
+
+    Uses the configured precision, not the one resolved from free memory, so
+    the signature (and the triage table fingerprint built from it) is the same
+    on every replica with the same settings. Under TRIAGE_CPU_MODE=auto a
+    table may therefore be served by a replica that fell back to a different
+    precision; pin TRIAGE_CPU_MODE when tables must match one precision exactly.
+    """
+    return (
+        f"{MODEL_NAME}|{configured_precision()}|prompt-v{PROMPT_VERSION}|mode={CLASSIFY_MODE}"
+        f"|constrained={int(CONSTRAINED_DECODING)}|summary={SUMMARY_MODE}"
+    )
+
+# Everything up to the clinical observations is identical for every request,
+# so it is kept separate from the per-request suffix.
+CLASSIFY_PROMPT_PREFIX = """<start_of_turn>user
 You are an expert pediatric triage assistant. 
 Analyze the following clinical observations for a child aged 6-12 and classify the triage level.
 
@@ -465,30 +872,45 @@ ADVICE_LIBRARY:
 - TEMPERATURE_CHECK: Check temperature periodically if fever is present.
 
 Return format:
-{{
+{
   "triage_level": "RED/YELLOW/GREEN",
   "reasoning": "A concise clinical explanation focusing on the severity and combination of symptoms provided.",
   "confidence": "High/Medium/Low",
   "home_advice": ["KEY1", "KEY2"]
-}}
+}
 
 Clinical Observations:
-{summary_text}<end_of_turn>
+"""
+
+CLASSIFY_TURN_END = """<end_of_turn>
 <start_of_turn>model
 """
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-    with torch.no_grad():
-        output = model.generate(
-            **inputs,
-            max_new_tokens=400,
-            temperature=0.0,
-            do_sample=False,
-            pad_token_id=tokenizer.eos_token_id
-        )
-    
-    generated_tokens = output[0][inputs["input_ids"].shape[-1]:]
-    response = tokenizer.decode(generated_tokens, skip_special_tokens=True).strip()
-    
+
+def classify_template(name, answer_prefix=""):
+    """
+    Register a classify prompt whose answer is forced to start with
+    `answer_prefix`. Only the summary varies per request.
+    """
+    return register_prompt(name, [CLASSIFY_PROMPT_PREFIX, Slot("summary"), CLASSIFY_TURN_END + answer_prefix])
+
+CLASSIFY_PROMPT = classify_template("classify")
+
+def build_prompt_suffix(summary_text):
+    return summary_text + CLASSIFY_TURN_END
+
+def build_prompt(summary_text):
+    return CLASSIFY_PROMPT.render(summary=summary_text)
+
+def prompt_token_counts(summary_text, template=None):
+    """Token count of each classify() prompt component for one summary."""
+    template = template or CLASSIFY_PROMPT
+    tokenizer, _ = get_model()
+    head = len(template.head_ids(tokenizer))
+    summary = len(tokenizer(summary_text, add_special_tokens=False)["input_ids"])
+    total = len(template.token_ids(tokenizer, summary=summary_text))
+    return {"preamble": head, "summary": summary, "turn_and_answer_prefix": total - head - summary, "total": total}
+
+def parse_response(response):
     # Try robust JSON extraction
     try:
         res = extract_json_response(response)
@@ -498,9 +920,329 @@ Clinical Observations:
         return res
     except Exception as e:
         # Fallback if AI fails JSON        
+        PARSE_FALLBACKS.inc("classify")
         return {
             "triage_level": "YELLOW",
-            "reasoning": f"AI analysis error. Precautionary triage applied.",
+            "reasoning": PARSE_FALLBACK_REASONING,
             "confidence": "Low",
             "home_advice": []
-        }
\ No newline at end of file
+        }
+
+def cacheable(res):
+    """
+    Whether a model result may be reused for identical answers. Precautionary
+    fallbacks from unparseable output are not: the next run may well succeed.
+    """
+    return res.get("triage_level") in VALID_TRIAGE and res.get("reasoning") != PARSE_FALLBACK_REASONING
+
+# Prefix ids and their KV cache, computed once per loaded model
+_prefix_cache = None
+_prefix_lock = threading.Lock()
+
+def get_prefix_cache(template=None):
+    """
+    Run the fixed prompt preamble through the model once and keep its KV cache.
+    Callers must copy the cache before generating, since generate() extends it,
+    and should hold a model_holder slot while calling this.
+    """
+    global _prefix_cache
+    template = template or CLASSIFY_PROMPT
+    tokenizer, model = get_model()
+    with _prefix_lock:
+        if _prefix_cache is None or _prefix_cache[0] is not model or _prefix_cache[1] != template.head:
+            prefix_ids = torch.tensor([template.head_ids(tokenizer)], dtype=torch.long, device=model.device)
+            with torch.no_grad():
+                out = model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True)
+            _prefix_cache = (model, template.head, prefix_ids, out.past_key_values)
+            logger.info("Cached classify preamble: %d tokens", prefix_ids.shape[-1])
+        return _prefix_cache[2], _prefix_cache[3]
+
+def clear_prefix_cache():
+    """Drop the cached preamble (and its reference to the model)."""
+    global _prefix_cache
+    with _prefix_lock:
+        _prefix_cache = None
+
+def build_inputs(summary_texts, template=None):
+    """
+    Token ids for generate(). Only the summaries are tokenized per call: the
+    template's fixed segments are pre-tokenized, and with the prefix cache
+    enabled the cached preamble is spliced in front of them.
+    """
+    template = template or CLASSIFY_PROMPT
+    tokenizer, model = get_model()
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    rows = [{"summary": text} for text in summary_texts]
+    if not USE_PREFIX_CACHE:
+        inputs = left_pad(template.batch_ids(tokenizer, rows), pad_id, model.device)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Prompt tokens per row: %s", inputs["attention_mask"].sum(dim=-1).tolist())
+        return inputs
+
+    prefix_ids, prefix_kv = get_prefix_cache(template)
+    suffixes = left_pad(template.batch_ids(tokenizer, rows, skip_head=True), pad_id, model.device)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Prompt tokens: preamble=%d (cached), per-row suffix=%s",
+            prefix_ids.shape[-1], suffixes["attention_mask"].sum(dim=-1).tolist()
+        )
+    n = len(summary_texts)
+    past_key_values = copy.deepcopy(prefix_kv)
+    if n > 1:
+        past_key_values.batch_repeat_interleave(n)
+    prefix_ids = prefix_ids.expand(n, -1)
+    return {
+        "input_ids": torch.cat([prefix_ids, suffixes["input_ids"]], dim=-1),
+        "attention_mask": torch.cat([torch.ones_like(prefix_ids), suffixes["attention_mask"]], dim=-1),
+        "past_key_values": past_key_values,
+    }
+
+# Lengths of recent well-formed outputs, used for the adaptive token budget
+output_lengths = OutputLengthTracker(CLASSIFY_MAX_NEW_TOKENS)
+
+def generation_kwargs(tokenizer, json_stop, max_new_tokens):
+    """Decoding settings shared by every classify() generation path."""
+    logits_processor = LogitsProcessorList()
+    if CONSTRAINED_DECODING:
+        shape = JsonShape(VALID_TRIAGE, VALID_ADVICE)
+        logits_processor.append(JsonShapeLogitsProcessor(tokenizer, shape))
+    return {
+        "logits_processor": logits_processor,
+        "stopping_criteria": StoppingCriteriaList([json_stop]),
+        "max_new_tokens": max_new_tokens,
+        "temperature": 0.0,
+        "do_sample": False,
+        "pad_token_id": tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+    }
+
+def generate_responses(summary_texts, max_new_tokens):
+    """
+    Run one padded generate() call. Each row stops as soon as its JSON object
+    closes; returns (response text, tokens until close or None, ran out of
+    budget) per row.
+    """
+    with model_holder.acquire() as (tokenizer, model):
+        inputs = build_inputs(summary_texts)
+        json_stop = JsonObjectStoppingCriteria(tokenizer)
+        started = time.perf_counter()
+        with torch.no_grad():
+            output = model.generate(**inputs, **generation_kwargs(tokenizer, json_stop, max_new_tokens))
+        elapsed = time.perf_counter() - started
+
+    prompt_len = inputs["input_ids"].shape[-1]
+    end_ids = {tokenizer.eos_token_id, tokenizer.pad_token_id}
+    closed = json_stop.closed_lengths() or [None] * len(output)
+    results = []
+    generated_tokens = 0
+    for row, closed_len in zip(output, closed):
+        generated = row[prompt_len:]
+        response = tokenizer.decode(generated, skip_special_tokens=True).strip()
+        hit_limit = closed_len is None and len(generated) >= max_new_tokens and generated[-1].item() not in end_ids
+        generated_tokens += closed_len if closed_len is not None else len(generated)
+        results.append((response, closed_len, hit_limit))
+    record_generation("classify", int(inputs["attention_mask"].sum()), generated_tokens, elapsed)
+    return results
+
+def classify_batch(summary_texts):
+    """
+    Classify several summaries with one padded generate() call.
+    Results are returned in the same order as the inputs.
+    """
+    if CLASSIFY_MODE == "score":
+        return score_batch(summary_texts)
+    budget = output_lengths.max_new_tokens() if ADAPTIVE_MAX_NEW_TOKENS else CLASSIFY_MAX_NEW_TOKENS
+    outputs = generate_responses(summary_texts, budget)
+
+    # Rows cut off by a reduced budget get one more try with the full one
+    if budget < CLASSIFY_MAX_NEW_TOKENS:
+        truncated = [i for i, (_, _, hit_limit) in enumerate(outputs) if hit_limit]
+        if truncated:
+            retried = generate_responses([summary_texts[i] for i in truncated], CLASSIFY_MAX_NEW_TOKENS)
+            for i, out in zip(truncated, retried):
+                outputs[i] = out
+
+    results = []
+    for response, closed, _ in outputs:
+        if closed is not None:
+            output_lengths.record(closed)
+        results.append(parse_response(response))
+    return results
+
+def classify(summary_text):
+    return classify_batch([summary_text])[0]
+
+# -----------------------------
+# LOGIT-SCORED CLASSIFICATION
+# -----------------------------
+# The answer is forced up to the opening quote of the triage level
+SCORE_ANSWER_PREFIX = '{\n  "triage_level": "'
+SCORE_PROMPT = classify_template("score", SCORE_ANSWER_PREFIX)
+SCORE_LEVELS = ["RED", "YELLOW", "GREEN"]
+# Advice for scored results (score mode, deferred reasoning); the model picks no advice keys
+DEFAULT_ADVICE = {
+    "RED": [],
+    "YELLOW": ["MONITOR_SYMPTOMS", "FLUIDS", "REST"],
+    "GREEN": ["REST", "FLUIDS", "MONITOR_SYMPTOMS"],
+}
+
+def level_probabilities(summary_texts):
+    """
+    Probability of each triage level per summary, from one forward pass over
+    the prompts plus a short teacher-forced pass over the label tokens.
+    Each label is scored with its closing quote so prefixes cannot win.
+    """
+    with model_holder.acquire() as (tokenizer, model):
+        inputs = build_inputs(summary_texts, SCORE_PROMPT)
+        cache = inputs.get("past_key_values")
+        past_len = cache.get_seq_length() if cache is not None else 0
+        mask = inputs["attention_mask"]
+        positions = (mask.long().cumsum(-1) - 1).clamp(min=0)
+
+        labels = [tokenizer(level + '"', add_special_tokens=False)["input_ids"] for level in SCORE_LEVELS]
+        n, k = len(summary_texts), len(labels)
+        width = max(len(ids) for ids in labels)
+
+        started = time.perf_counter()
+        with torch.no_grad():
+            out = model(
+                input_ids=inputs["input_ids"][:, past_len:],
+                attention_mask=mask,
+                position_ids=positions[:, past_len:],
+                past_key_values=cache if cache is not None else DynamicCache(),
+                use_cache=True
+            )
+            first = torch.log_softmax(out.logits[:, -1, :].float(), dim=-1)
+            scores = torch.stack([first[:, ids[0]] for ids in labels], dim=-1)
+
+            if width > 1:
+                # Feed every label's tokens but the last, all labels side by side
+                pad = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+                feed = torch.tensor([ids[:-1] + [pad] * (width - len(ids)) for ids in labels], device=model.device)
+                feed_mask = torch.tensor([[1] * (len(ids) - 1) + [0] * (width - len(ids)) for ids in labels], device=model.device)
+                cache = out.past_key_values
+                cache.batch_repeat_interleave(k)
+                steps = torch.arange(1, width, device=model.device)
+                out = model(
+                    input_ids=feed.repeat(n, 1),
+                    attention_mask=torch.cat([mask.repeat_interleave(k, dim=0), feed_mask.repeat(n, 1)], dim=-1),
+                    position_ids=positions[:, -1:].repeat_interleave(k, dim=0) + steps,
+                    past_key_values=cache,
+                    use_cache=True
+                )
+                rest = torch.log_softmax(out.logits.float(), dim=-1).view(n, k, width - 1, -1)
+                for j, ids in enumerate(labels):
+                    for t, token in enumerate(ids[1:]):
+                        scores[:, j] += rest[:, j, t, token]
+
+        probs = torch.softmax(scores, dim=-1).tolist()
+    # Label tokens are teacher-forced, not generated
+    record_generation("score", int(mask.sum()), 0, time.perf_counter() - started)
+    return [dict(zip(SCORE_LEVELS, row)) for row in probs]
+
+def score_batch(summary_texts):
+    """classify_batch() equivalent that only scores the triage level."""
+    results = []
+    for probs in level_probabilities(summary_texts):
+        level = max(probs, key=probs.get)
+        summary = ", ".join(f"{lvl} {p:.2f}" for lvl, p in probs.items())
+        results.append({
+            "triage_level": level,
+            "reasoning": f"Triage level scored from model label probabilities ({summary}).",
+            "confidence": f"{probs[level]:.2f}",
+            "home_advice": list(DEFAULT_ADVICE[level]),
+            "generic_advice": True,
+            "level_probabilities": {lvl: round(p, 4) for lvl, p in probs.items()},
+        })
+    return results
+
+# -----------------------------
+# DEFERRED REASONING
+# -----------------------------
+# One template per level, so the whole forced answer is pre-tokenized
+EXPLAIN_PROMPTS = {
+    level: classify_template(f"explain-{level}", f'{{\n  "triage_level": "{level}",\n  "reasoning": "')
+    for level in VALID_TRIAGE
+}
+
+def explain(summary_text, triage_level):
+    """
+    Generate only the reasoning for an already decided triage level: the
+    answer is forced up to the opening quote of "reasoning" and generation
+    stops as soon as that string closes.
+    """
+    with model_holder.acquire() as (tokenizer, model):
+        inputs = build_inputs([summary_text], EXPLAIN_PROMPTS[triage_level])
+        json_stop = JsonObjectStoppingCriteria(tokenizer, depth=1, in_string=True, stop_at_string_end=True)
+        kwargs = generation_kwargs(tokenizer, json_stop, CLASSIFY_MAX_NEW_TOKENS)
+        # The JSON shape constraint starts at "{", which is already forced here
+        kwargs["logits_processor"] = LogitsProcessorList()
+        started = time.perf_counter()
+        with torch.no_grad():
+            output = model.generate(**inputs, **kwargs)
+        elapsed = time.perf_counter() - started
+    prompt_len = inputs["input_ids"].shape[-1]
+    record_generation("explain", int(inputs["attention_mask"].sum()), len(output[0]) - prompt_len, elapsed)
+    text = tokenizer.decode(output[0][prompt_len:], skip_special_tokens=True)
+
+    # Everything up to the first unescaped quote is the reasoning string
+    match = re.match(r'((?:[^"\\]|\\.)*)', text)
+    body = match.group(1).strip() if match else ""
+    try:
+        reasoning = json.loads(f'"{body}"').strip()
+    except ValueError:
+        reasoning = body
+    # An immediately closed or empty string is no explanation at all
+    if not reasoning:
+        PARSE_FALLBACKS.inc("explain")
+        return PARSE_FALLBACK_REASONING
+    return reasoning
+
+# -----------------------------
+# STREAMING CLASSIFICATION
+# -----------------------------
+TRIAGE_LEVEL_PATTERN = re.compile(r'"triage_level"\s*:\s*"(RED|YELLOW|GREEN)"')
+
+def find_triage_level(partial_text):
+    """Return the triage level once it has been fully decoded, else None."""
+    match = TRIAGE_LEVEL_PATTERN.search(partial_text)
+    return match.group(1) if match else None
+
+def stream_classify(summary_text):
+    """
+    Yield decoded text chunks for one summary as generate() produces them.
+    The caller accumulates the text and passes it to parse_response().
+    """
+    tokenizer, _ = get_model()
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    json_stop = JsonObjectStoppingCriteria(tokenizer)
+    usage = {}
+    failure = []
+
+    def run():
+        try:
+            with model_holder.acquire() as (tokenizer, model):
+                inputs = build_inputs([summary_text])
+                kwargs = generation_kwargs(tokenizer, json_stop, CLASSIFY_MAX_NEW_TOKENS)
+                started = time.perf_counter()
+                with torch.no_grad():
+                    output = model.generate(**inputs, streamer=streamer, **kwargs)
+                usage["seconds"] = time.perf_counter() - started
+                usage["prompt"] = int(inputs["attention_mask"].sum())
+                usage["generated"] = output.shape[-1] - inputs["input_ids"].shape[-1]
+        except Exception as e:
+            # Unblock the consumer, which re-raises this once the stream ends
+            failure.append(e)
+            streamer.end()
+
+    thread = threading.Thread(target=run, name="triage-stream", daemon=True)
+    thread.start()
+    for chunk in streamer:
+        yield chunk
+    thread.join()
+    if failure:
+        raise failure[0]
+    if usage:
+        record_generation("classify", usage["prompt"], usage["generated"], usage["seconds"])
+    closed = json_stop.closed_lengths()
+    if closed and closed[0] is not None:
+        output_lengths.record(closed[0])
\ No newline at end of file
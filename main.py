@@ -1,29 +1,145 @@
-from fastapi import FastAPI, HTTPException
-from .schemas import TriageRequest, TriageResponse
-from .logic import QUESTIONS, check_red_flags, build_summary, classify, HOME_ADVICE_LIBRARY
+import os
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import ValidationError
+from .schemas import TriageRequest, TriageResponse, ReasoningResponse, TriageBatchRequest
+from .logic import (
+    build_summary, HOME_ADVICE_LIBRARY,
+    find_triage_level, parse_response, score_batch, explain, cacheable, CLASSIFY_MODE, PARSE_FALLBACK_REASONING
+)
+from .batching import MicroBatcher, InferenceQueueFull
+from .assessments import ReasoningStore
+from .rules import red_flag_engine
+from .encoding import answers_key
+from .payloads import build_question_payloads
+from .cache import ResultCache
+from .table import load_table, enumerate_weighted
+from .metrics import CONTENT_TYPE, QUEUE_DEPTH, TRIAGE_LATENCY, TRIAGE_RESULTS, render_metrics
 
-app = FastAPI(title="Pediatric Triage API")
+# Synthetic generations run at startup before the replica reports ready
+WARMUP_RUNS = int(os.environ.get("TRIAGE_WARMUP_RUNS", "2"))
+# Upper bound on how long /triage/{id}/reasoning may hold a long-poll open
+MAX_LONG_POLL_SECONDS = 30.0
+# Largest upload accepted by /triage/batch
+MAX_BATCH_ITEMS = int(os.environ.get("TRIAGE_MAX_BATCH_ITEMS", "1000"))
+# Model jobs one /triage/batch call keeps queued at once, leaving room for /triage traffic
+BATCH_WINDOW = int(os.environ.get("TRIAGE_BATCH_WINDOW", "16"))
+
+# Bounded inference queue; concurrent /triage requests share padded generate() calls
+batcher = MicroBatcher()
+# Deferred-reasoning requests get their level from a single scoring pass
+score_batcher = batcher if CLASSIFY_MODE == "score" else MicroBatcher(batch_fn=score_batch)
+# Reasoning still being generated for already answered assessments
+reasoning_store = ReasoningStore()
+# Greedy decoding is deterministic, so repeated answer patterns skip the model
+result_cache = ResultCache()
+# Precomputed results for the most frequent answer sets (see table.py)
+triage_table = load_table()
+# /questions bodies, serialized and gzipped once
+question_payloads = build_question_payloads()
+# Every queue in front of the model, for the queue-depth gauge
+inference_queues = [batcher] if score_batcher is batcher else [batcher, score_batcher]
+QUEUE_DEPTH.set_function(lambda: sum(q.stats()["queue_depth"] for q in inference_queues))
+
+readiness = {"ready": False, "warmup_runs": 0, "error": None}
+
+def warm_up_model():
+    """
+    Load the model and run synthetic classifications on the model worker,
+    so weights, prefix cache and first-inference costs are paid before any
+    patient request. At least one run is needed to load the model.
+    """
+    for answers in enumerate_weighted(max(1, WARMUP_RUNS)):
+        batcher.classify(build_summary(answers))
+        readiness["warmup_runs"] += 1
+
+async def warm_up():
+    try:
+        await asyncio.to_thread(warm_up_model)
+        readiness["ready"] = True
+    except Exception as e:
+        readiness["error"] = repr(e)
+
+@asynccontextmanager
+async def lifespan(app):
+    # Warm up in the background so /healthz answers while the model loads
+    batcher.start()
+    score_batcher.start()
+    task = asyncio.create_task(warm_up())
+    yield
+    task.cancel()
+
+app = FastAPI(title="Pediatric Triage API", lifespan=lifespan)
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readyz():
+    if not readiness["ready"]:
+        raise HTTPException(status_code=503, detail=dict(readiness))
+    return {"status": "ready", "warmup_runs": readiness["warmup_runs"]}
 
 @app.get("/questions")
-def get_questions():
-    return QUESTIONS
+async def get_questions(request: Request, lang: Optional[str] = None):
+    """
+    The questionnaire; ?lang=en|ml serves a slim variant with only that
+    language's labels and no server-side context text. Gzipped when accepted,
+    with an ETag for conditional requests.
+    """
+    payload = question_payloads.get(lang)
+    if payload is None:
+        raise HTTPException(status_code=422, detail=f"Unsupported lang {lang!r}")
+    return payload.response(request.headers)
 
-@app.post("/triage", response_model=TriageResponse)
-def perform_triage(request: TriageRequest):
-    answers = request.answers
-    
+@app.get("/stats")
+async def get_stats():
+    return {
+        "cache": result_cache.stats(),
+        "queue": batcher.stats(),
+        "score_queue": score_batcher.stats() if score_batcher is not batcher else None,
+        "pending_reasoning": len(reasoning_store),
+        "table_entries": len(triage_table) if triage_table is not None else 0,
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition of latency, level, token and process metrics."""
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
+
+def observe(endpoint, path, res, started):
+    TRIAGE_LATENCY.observe(time.perf_counter() - started, endpoint, path)
+    TRIAGE_RESULTS.inc(res["triage_level"], path)
+
+def lookup_known_result(answers):
+    """
+    Red-flag override, or a materialized/cached result, with the path that
+    decided it ("red_flag", "table" or "cache"); (None, None) if the model is needed.
+    """
     # 1. Check Red Flags
-    red_flag = check_red_flags(answers)
+    red_flag = red_flag_engine.screen(answers)
     if red_flag:
-        res = red_flag
-    else:
-        # 2. AI Classification
-        summary = build_summary(answers)
-        res = classify(summary)
-    
+        return red_flag, "red_flag"
+    # 2. Materialized or cached result for an identical answer pattern
+    return lookup_stored_result(answers)
+
+def lookup_stored_result(answers):
+    res = triage_table.lookup(answers) if triage_table is not None else None
+    if res is not None:
+        return res, "table"
+    res = result_cache.get(answers_key(answers))
+    return (res, "cache") if res is not None else (None, None)
+
+def add_advice_texts(res, language):
     # Enrich with translated advice texts
     advice_texts = []
-    lang = request.language if request.language in ["en", "ml"] else "en"
+    lang = language if language in ["en", "ml"] else "en"
     for key in res.get("home_advice", []):
         advice_item = HOME_ADVICE_LIBRARY.get(key)
         if advice_item:
@@ -32,6 +148,201 @@ def perform_triage(request: TriageRequest):
     res["advice_texts"] = advice_texts
     return res
 
+def queue_full(e):
+    return HTTPException(
+        status_code=503,
+        detail="Triage model is busy. Please retry shortly.",
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+@app.post("/triage", response_model=TriageResponse)
+async def perform_triage(request: TriageRequest):
+    started = time.perf_counter()
+    answers = request.answers
+    res, path = lookup_known_result(answers)
+    if res is None and request.defer_reasoning:
+        res = await triage_with_deferred_reasoning(answers)
+        path = "scored"
+    elif res is None:
+        # 3. AI Classification on the model worker
+        summary = build_summary(answers)
+        try:
+            future = batcher.submit(summary)
+        except InferenceQueueFull as e:
+            raise queue_full(e)
+        res = await asyncio.wrap_future(future)
+        if cacheable(res):
+            result_cache.put(answers_key(answers), res)
+        path = "model"
+    observe("triage", path, res, started)
+    return add_advice_texts(res, request.language)
+
+async def triage_with_deferred_reasoning(answers):
+    """
+    Score the level (with generic advice for it) now and queue reasoning
+    generation for the decided level; the caller fetches it by assessment_id.
+    """
+    summary = build_summary(answers)
+    try:
+        future = score_batcher.submit(summary)
+    except InferenceQueueFull as e:
+        raise queue_full(e)
+    res = await asyncio.wrap_future(future)
+    try:
+        reasoning = batcher.submit_call(explain, summary, res["triage_level"])
+    except InferenceQueueFull:
+        # No room for background work; the scored explanation stands
+        return res
+    res["assessment_id"] = reasoning_store.add(reasoning)
+    res["reasoning"] = ""
+    res["reasoning_pending"] = True
+    return res
+
+@app.get("/triage/{assessment_id}/reasoning", response_model=ReasoningResponse)
+async def get_reasoning(assessment_id: str, wait: float = 0):
+    """Deferred reasoning; `wait` seconds long-polls until it is ready."""
+    future = reasoning_store.get(assessment_id)
+    if future is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired assessment id")
+    if not future.done() and wait > 0:
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=min(wait, MAX_LONG_POLL_SECONDS))
+        except Exception:
+            pass
+    if not future.done():
+        return {"assessment_id": assessment_id, "status": "pending"}
+    if future.exception() is not None:
+        return {"assessment_id": assessment_id, "status": "failed", "reasoning": PARSE_FALLBACK_REASONING}
+    return {"assessment_id": assessment_id, "status": "ready", "reasoning": future.result()}
+
+def ndjson_line(data):
+    return json.dumps(data, ensure_ascii=False, default=str) + "\n"
+
+@app.post("/triage/batch")
+async def triage_batch(request: TriageBatchRequest):
+    """
+    Triage many assessments in one call. Results stream back as NDJSON, one
+    line per item in completion order: {"index", "status", "result"} or
+    {"index", "status", "error"}. Red flags are screened for the whole batch
+    at once; identical answer sets share one model run.
+    """
+    if len(request.items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_ITEMS} items per batch")
+
+    async def results():
+        valid = []
+        for index, raw in enumerate(request.items):
+            if not isinstance(raw, dict):
+                yield ndjson_line({"index": index, "status": 422, "error": "Item must be a JSON object"})
+                continue
+            try:
+                valid.append((index, TriageRequest(**raw)))
+            except ValidationError as e:
+                yield ndjson_line({"index": index, "status": 422, "error": e.errors()})
+
+        # Items needing the model, grouped by answer pattern
+        waiting = {}
+        red_flags = red_flag_engine.screen_batch([item.answers for _, item in valid])
+        for (index, item), red_flag in zip(valid, red_flags):
+            res, path = (red_flag, "red_flag") if red_flag else lookup_stored_result(item.answers)
+            if res is not None:
+                TRIAGE_RESULTS.inc(res["triage_level"], path)
+                yield ndjson_line({"index": index, "status": 200, "result": add_advice_texts(res, item.language)})
+            else:
+                waiting.setdefault(answers_key(item.answers), []).append((index, item))
+
+        # Popped from the end, so reversed to submit in upload order
+        todo = list(waiting.items())[::-1]
+        running = {}
+        while todo or running:
+            while todo and len(running) < BATCH_WINDOW:
+                key, group = todo[-1]
+                try:
+                    future = batcher.submit(build_summary(group[0][1].answers))
+                except InferenceQueueFull as e:
+                    if running:
+                        break
+                    # The queue is full of other traffic; wait for it to drain
+                    await asyncio.sleep(min(e.retry_after, 1))
+                    continue
+                todo.pop()
+                running[asyncio.wrap_future(future)] = (key, group)
+            if not running:
+                continue
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                key, group = running.pop(future)
+                if future.exception() is not None:
+                    for index, _ in group:
+                        yield ndjson_line({"index": index, "status": 500, "error": repr(future.exception())})
+                    continue
+                res = future.result()
+                if cacheable(res):
+                    result_cache.put(key, res)
+                TRIAGE_RESULTS.inc(res["triage_level"], "model", amount=len(group))
+                for index, item in group:
+                    yield ndjson_line({"index": index, "status": 200, "result": add_advice_texts(dict(res), item.language)})
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/triage/stream")
+async def stream_triage(request: TriageRequest):
+    """
+    Server-sent events: `triage_level` as soon as it is known, `token` for
+    each decoded chunk of model output, then `result` with the full response.
+    """
+    started = time.perf_counter()
+    answers = request.answers
+    known, path = lookup_known_result(answers)
+    if known is not None:
+        observe("stream", path, known, started)
+        async def known_events():
+            yield sse_event("triage_level", {"triage_level": known["triage_level"]})
+            yield sse_event("result", add_advice_texts(known, request.language))
+        return StreamingResponse(known_events(), media_type="text/event-stream")
+
+    # Chunks are handed over from the model worker thread to the event loop
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    on_chunk = lambda chunk: loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+    try:
+        future = batcher.submit_stream(build_summary(answers), on_chunk)
+    except InferenceQueueFull as e:
+        raise queue_full(e)
+    done = asyncio.wrap_future(future)
+    done.add_done_callback(lambda _: chunks.put_nowait(None))
+
+    async def events():
+        text = ""
+        level_sent = False
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            text += chunk
+            yield sse_event("token", {"text": chunk})
+            if not level_sent:
+                level = find_triage_level(text)
+                if level:
+                    level_sent = True
+                    yield sse_event("triage_level", {"triage_level": level})
+
+        if done.exception() is None:
+            res = parse_response(done.result())
+            if cacheable(res):
+                result_cache.put(answers_key(answers), res)
+        else:
+            res = parse_response(text)
+        observe("stream", "model", res, started)
+        if not level_sent:
+            yield sse_event("triage_level", {"triage_level": res["triage_level"]})
+        yield sse_event("result", add_advice_texts(dict(res), request.language))
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,179 @@
+import os
+import threading
+from bisect import bisect_left
+
+# -----------------------------
+# CONFIG
+# -----------------------------
+# Seconds; spans the red-flag short-circuit (well under 1 ms) to slow CPU generations
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# -----------------------------
+# METRIC TYPES
+# -----------------------------
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    One metric family in the Prometheus text format. Label values are passed
+    positionally, in the order of `labels`; each series is a dict entry, so
+    an update costs one lock and one dict lookup.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=(), registry=None):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._series = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def samples(self):
+        with self._lock:
+            series = list(self._series.items())
+        for values, value in sorted(series):
+            yield f"{self.name}{self._label_text(values)} {_format(value)}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A settable value, or one read from `fn` at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), fn=None, registry=None):
+        super().__init__(name, help_text, labels, registry)
+        self.fn = fn
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._series[labels] = value
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def samples(self):
+        if self.fn is not None:
+            value = self.fn()
+            if value is not None:
+                yield f"{self.name} {_format(value)}"
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        super().__init__(name, help_text, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        # Per-bucket counts (last one is +Inf), then sum; cumulated at scrape time
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            series = [(values, list(counts)) for values, counts in self._series.items()]
+        for values, counts in sorted(series):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                yield f"{self.name}_bucket{self._label_text(values, [('le', _format(float(bound)))])} {total}"
+            yield f"{self.name}_sum{self._label_text(values)} {_format(counts[-1])}"
+            yield f"{self.name}_count{self._label_text(values)} {total}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# -----------------------------
+# PROCESS
+# -----------------------------
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def resident_memory_bytes():
+    """Current RSS from /proc (Linux); None where it is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+# -----------------------------
+# TRIAGE SERVICE METRICS
+# -----------------------------
+# path: red_flag, table, cache, model or scored (deferred reasoning)
+TRIAGE_LATENCY = Histogram(
+    "triage_request_duration_seconds", "Time to a triage result, by endpoint and how it was decided.",
+    ("endpoint", "path")
+)
+TRIAGE_RESULTS = Counter("triage_results_total", "Triage results returned, by level and path.", ("level", "path"))
+PARSE_FALLBACKS = Counter(
+    "triage_parse_fallbacks_total", "Model outputs that could not be parsed and fell back to the precautionary result.",
+    ("task",)
+)
+PROMPT_TOKENS = Counter("triage_prompt_tokens_total", "Prompt tokens run through the model.", ("task",))
+GENERATED_TOKENS = Counter("triage_generated_tokens_total", "Tokens generated by the model.", ("task",))
+GENERATION_LATENCY = Histogram("triage_generation_duration_seconds", "Time spent in one model call.", ("task",))
+GENERATION_THROUGHPUT = Gauge(
+    "triage_generation_tokens_per_second", "Generated tokens per second in the most recent model call.", ("task",)
+)
+GENERATIONS_IN_FLIGHT = Gauge("triage_generations_in_flight", "Model calls currently holding a generation slot.")
+QUEUE_DEPTH = Gauge("triage_inference_queue_depth", "Requests waiting for the model workers, classify and scoring queues combined.")
+RESIDENT_MEMORY = Gauge(
+    "process_resident_memory_bytes", "Resident memory size in bytes.", fn=resident_memory_bytes
+)
+
+def record_generation(task, prompt_tokens, generated_tokens, seconds):
+    PROMPT_TOKENS.inc(task, amount=prompt_tokens)
+    GENERATION_LATENCY.observe(seconds, task)
+    if generated_tokens:
+        GENERATED_TOKENS.inc(task, amount=generated_tokens)
+        if seconds > 0:
+            GENERATION_THROUGHPUT.set(generated_tokens / seconds, task)
+
+def render_metrics():
+    return REGISTRY.render()
@@ -0,0 +1,237 @@
+"""
+Offline triage for field devices. Standard library only: it loads the bundle
+written by bundle.py and needs neither the model nor the server.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+BUNDLE_FORMAT = "gramcare-offline-bundle"
+BUNDLE_VERSION = 1
+# Same personalization as encoding.AnswerVector.hash64, so table keys agree
+ANSWER_HASH_PERSON = b"answer-vector-v1"
+# Assessments per /triage/batch upload; the server's TRIAGE_MAX_BATCH_ITEMS default
+SYNC_BATCH_SIZE = 1000
+
+
+class SyncError(Exception):
+    """A sync upload failed; `synced` holds the records sent before it."""
+
+    def __init__(self, synced, cause):
+        super().__init__(f"Sync stopped after {len(synced)} assessments: {cause}")
+        self.synced = synced
+        self.cause = cause
+
+
+class OfflineTriage:
+    """
+    Red-flag rules and materialized results from a bundle, evaluated locally.
+    Every assessment is kept in an outbox until sync() has sent it to the
+    server's /triage/batch; those the bundle could not decide get their
+    result then.
+    """
+
+    def __init__(self, bundle, outbox_path=None):
+        if bundle.get("format") != BUNDLE_FORMAT or bundle.get("version") != BUNDLE_VERSION:
+            raise ValueError("Not an offline triage bundle or unsupported bundle version")
+        self.bundle_id = bundle["bundle_id"]
+        self.advice = bundle["advice"]
+        questions = bundle["questions"]
+        self._question_ids = [q["id"] for q in questions]
+        self._codes_by_str = [{str(v): i + 1 for i, v in enumerate(q["values"])} for q in questions]
+
+        rules = bundle["red_flags"]
+        values = {q["id"]: q["values"] for q in questions}
+        self._rule_names = rules["names"]
+        self._rule_masks = rules["rule_masks"]
+        self._red_flag_result = rules["result"]
+        self._lookups = [
+            (r["id"], dict(zip(values[r["id"]], r["values"])), r["unanswered"], r["other"])
+            for r in rules["questions"]
+        ]
+
+        results = bundle.get("results") or {}
+        self._strings = results.get("strings", [])
+        self._results = results.get("entries", {})
+
+        self.outbox_path = outbox_path
+        self.outbox = []
+        if outbox_path and os.path.exists(outbox_path):
+            with open(outbox_path, encoding="utf-8") as f:
+                self.outbox = [json.loads(line) for line in f if line.strip()]
+
+    @classmethod
+    def load(cls, path, outbox_path=None):
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:2] == b"\x1f\x8b":
+            data = gzip.decompress(data)
+        return cls(json.loads(data), outbox_path)
+
+    # -----------------------------
+    # EVALUATION
+    # -----------------------------
+    def red_flag(self, answers):
+        """Name of the first red-flag rule that fires, or None."""
+        satisfied = 0
+        for q_id, by_value, unanswered, other in self._lookups:
+            value = answers.get(q_id)
+            if value is None:
+                satisfied |= unanswered
+            else:
+                try:
+                    satisfied |= by_value.get(value, other)
+                except TypeError:
+                    satisfied |= other
+        for name, mask in zip(self._rule_names, self._rule_masks):
+            if satisfied & mask == mask:
+                return name
+        return None
+
+    def answers_hash(self, answers):
+        """Materialized-result key of the answers, or None if they hold values outside the options."""
+        codes = bytearray(len(self._question_ids))
+        for i, q_id in enumerate(self._question_ids):
+            value = answers.get(q_id)
+            if value is not None:
+                code = self._codes_by_str[i].get(str(value))
+                if code is None:
+                    return None
+                codes[i] = code
+        digest = hashlib.blake2b(bytes(codes), digest_size=8, person=ANSWER_HASH_PERSON).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def evaluate(self, answers, language="en"):
+        """
+        Local result for the answers: a red-flag override, a materialized
+        result, or None if only the server's model can decide.
+        """
+        lang = language if language in ("en", "ml") else "en"
+        rule = self.red_flag(answers)
+        if rule is not None:
+            res = dict(self._red_flag_result, source="offline_rules", red_flag=rule)
+        else:
+            h = self.answers_hash(answers)
+            entry = self._results.get(f"{h:016x}") if h is not None else None
+            if entry is None:
+                return None
+            level, reasoning, confidence, advice = entry
+            res = {
+                "triage_level": level,
+                "reasoning": self._strings[reasoning],
+                "confidence": self._strings[confidence],
+                "home_advice": list(advice),
+                "source": "offline_table",
+            }
+        res["advice_texts"] = [self.advice[k][lang] for k in res["home_advice"] if k in self.advice]
+        return res
+
+    def triage(self, answers, language="en"):
+        """Evaluate locally and queue the assessment for the next sync."""
+        res = self.evaluate(answers, language)
+        record = {
+            "id": uuid.uuid4().hex,
+            "created": time.time(),
+            "answers": answers,
+            "language": language,
+            "bundle_id": self.bundle_id,
+            "offline_result": res,
+        }
+        self.outbox.append(record)
+        if self.outbox_path:
+            with open(self.outbox_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return res if res is not None else {"triage_level": None, "pending_sync": True, "id": record["id"]}
+
+    # -----------------------------
+    # SYNC
+    # -----------------------------
+    def sync(self, server_url, timeout=60, batch_size=SYNC_BATCH_SIZE):
+        """
+        Send the queued assessments to /triage/batch, `batch_size` at a time.
+        Returns the synced records with their `server_result`; items the server
+        rejected stay queued for the next attempt. The outbox is saved after
+        every upload, so if one fails (SyncError) earlier uploads stay synced.
+        """
+        done = []
+        start = 0
+        while start < len(self.outbox):
+            chunk = self.outbox[start:start + batch_size]
+            try:
+                results = self._upload(server_url, chunk, timeout)
+            except urllib.error.HTTPError as e:
+                if e.code == 413 and batch_size > 1:
+                    # The server takes fewer items per batch than we assumed
+                    batch_size = max(1, batch_size // 2)
+                    continue
+                raise SyncError(done, e) from e
+            except (OSError, ValueError) as e:
+                raise SyncError(done, e) from e
+
+            remaining = []
+            for i, record in enumerate(chunk):
+                if i in results:
+                    done.append(dict(record, server_result=results[i]))
+                else:
+                    remaining.append(record)
+            self.outbox[start:start + len(chunk)] = remaining
+            start += len(remaining)
+            self._save_outbox()
+        return done
+
+    def _upload(self, server_url, records, timeout):
+        """POST one batch; returns {index in batch: result} for the accepted items."""
+        items = [{"answers": r["answers"], "language": r["language"]} for r in records]
+        request = urllib.request.Request(
+            server_url.rstrip("/") + "/triage/batch",
+            data=json.dumps({"items": items}, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        results = {}
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            for line in response:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                if row.get("status") == 200:
+                    results[row["index"]] = row["result"]
+        return results
+
+    def _save_outbox(self):
+        if not self.outbox_path:
+            return
+        tmp = self.outbox_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for record in self.outbox:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.outbox_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Triage answers offline with an exported bundle.")
+    parser.add_argument("bundle", help="Bundle written by bundle.py")
+    parser.add_argument("answers", nargs="?", help="JSON file with one answers object or a list of them")
+    parser.add_argument("--language", default="en")
+    parser.add_argument("--outbox", default="triage_outbox.jsonl", help="Queued assessments awaiting sync")
+    parser.add_argument("--sync", metavar="SERVER_URL", help="Send queued assessments to the server")
+    parser.add_argument("--batch-size", type=int, default=SYNC_BATCH_SIZE, help="Assessments per sync upload")
+    args = parser.parse_args()
+
+    triage = OfflineTriage.load(args.bundle, args.outbox)
+    if args.answers:
+        with open(args.answers, encoding="utf-8") as f:
+            data = json.load(f)
+        for answers in data if isinstance(data, list) else [data]:
+            print(json.dumps(triage.triage(answers, args.language), ensure_ascii=False))
+    if args.sync:
+        for record in triage.sync(args.sync, batch_size=args.batch_size):
+            print(json.dumps({"id": record["id"], "server_result": record["server_result"]}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
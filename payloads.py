@@ -0,0 +1,97 @@
+import gzip
+import hashlib
+import json
+
+from fastapi import Response
+
+from .logic import QUESTIONS, QUESTIONNAIRE, LANGUAGES
+
+# Clients revalidate with If-None-Match after this; the questionnaire only
+# changes with a deploy
+QUESTIONS_MAX_AGE_SECONDS = 300
+
+# -----------------------------
+# PRECOMPUTED JSON RESPONSES
+# -----------------------------
+def accepts_gzip(accept_encoding):
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if coding.strip().lower() in ("gzip", "*"):
+            q = params.strip().lower()
+            if not q.startswith("q="):
+                return True
+            try:
+                return float(q[2:] or 0) > 0
+            except ValueError:
+                # Malformed weight: do not risk an encoding the client may not take
+                return False
+    return False
+
+
+class PrecomputedJSON:
+    """
+    A JSON body serialized and gzip-compressed once, with a strong ETag per
+    encoding. Requests whose If-None-Match matches get an empty 304.
+    """
+
+    def __init__(self, data, max_age=QUESTIONS_MAX_AGE_SECONDS):
+        self.body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.gzip_body = gzip.compress(self.body, compresslevel=9, mtime=0)
+        digest = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gzip"'
+        self.cache_control = f"public, max-age={max_age}"
+
+    def matches(self, if_none_match):
+        if not if_none_match:
+            return False
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        return "*" in tags or self.etag in tags or self.gzip_etag in tags
+
+    def response(self, headers):
+        compressed = accepts_gzip(headers.get("accept-encoding"))
+        out = {
+            "ETag": self.gzip_etag if compressed else self.etag,
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if self.matches(headers.get("if-none-match")):
+            return Response(status_code=304, headers=out)
+        if compressed:
+            out["Content-Encoding"] = "gzip"
+            return Response(self.gzip_body, media_type="application/json", headers=out)
+        return Response(self.body, media_type="application/json", headers=out)
+
+
+# -----------------------------
+# QUESTIONNAIRE PAYLOADS
+# -----------------------------
+def full_questions():
+    """QUESTIONS as served so far, minus callable contexts that cannot be serialized."""
+    return {
+        cat: {q_id: {k: v for k, v in q_data.items() if not callable(v)} for q_id, q_data in qs.items()}
+        for cat, qs in QUESTIONS.items()
+    }
+
+def slim_questions(lang):
+    """Only what a client rendering `lang` needs: no other-language strings, no context."""
+    payload = {}
+    for category, _, records in QUESTIONNAIRE.categories:
+        section = payload[category] = {}
+        for q in records:
+            item = {lang: q.labels[lang], "type": q.type}
+            if q.type == "number":
+                item["min"], item["max"] = q.min, q.max
+            else:
+                item["options"] = {v: {lang: label} for v, label in zip(q.values, q.option_labels[lang])}
+            if q.is_critical:
+                item["is_critical"] = True
+            section[q.q_id] = item
+    return payload
+
+def build_question_payloads():
+    """Payload per ?lang= value; None is the full bilingual payload."""
+    payloads = {None: PrecomputedJSON(full_questions())}
+    for lang in LANGUAGES:
+        payloads[lang] = PrecomputedJSON(slim_questions(lang))
+    return payloads
@@ -0,0 +1,125 @@
+import threading
+
+import torch
+
+# -----------------------------
+# PRE-TOKENIZED PROMPT TEMPLATES
+# -----------------------------
+class Slot:
+    """A per-request part of a PromptTemplate, filled in by keyword."""
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class PromptTemplate:
+    """
+    A prompt made of fixed text segments and named Slots. The fixed segments
+    are tokenized once per tokenizer; per request only the slot values are
+    tokenized and spliced in as ids.
+
+    Segments are tokenized separately, so every slot must sit at a boundary
+    the tokenizer never merges across (a newline or special token).
+    `matches_full_tokenization` checks that for a given set of slot values.
+    """
+
+    def __init__(self, name, segments, add_bos=True):
+        self.name = name
+        self.segments = [s if isinstance(s, Slot) else str(s) for s in segments]
+        self.slots = [s.name for s in self.segments if isinstance(s, Slot)]
+        self.add_bos = add_bos
+        # Text before the first slot; identical for every request
+        head = []
+        for s in self.segments:
+            if isinstance(s, Slot):
+                break
+            head.append(s)
+        self.head = "".join(head)
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def render(self, **values):
+        """The full prompt as text."""
+        return "".join(values[s.name] if isinstance(s, Slot) else s for s in self.segments)
+
+    def _segment_ids(self, tokenizer):
+        """Token ids of every fixed segment, computed once per tokenizer."""
+        key = id(tokenizer)
+        ids = self._ids.get(key)
+        if ids is None:
+            with self._lock:
+                ids = self._ids.get(key)
+                if ids is None:
+                    ids = [
+                        None if isinstance(s, Slot) else tokenizer(s, add_special_tokens=False)["input_ids"]
+                        for s in self.segments
+                    ]
+                    self._ids[key] = ids
+        return ids
+
+    def _bos(self, tokenizer):
+        return [tokenizer.bos_token_id] if self.add_bos and tokenizer.bos_token_id is not None else []
+
+    def head_ids(self, tokenizer):
+        """Ids of the fixed text before the first slot, including BOS."""
+        ids = list(self._bos(tokenizer))
+        for s, seg in zip(self.segments, self._segment_ids(tokenizer)):
+            if isinstance(s, Slot):
+                break
+            ids += seg
+        return ids
+
+    def batch_ids(self, tokenizer, rows, skip_head=False):
+        """
+        Token ids for each row of slot values (a dict per row). Each slot is
+        tokenized for the whole batch in one tokenizer call. With `skip_head`
+        the fixed text before the first slot (and BOS) is left out.
+        """
+        filled = {}
+        for name in set(self.slots):
+            filled[name] = tokenizer([row[name] for row in rows], add_special_tokens=False)["input_ids"]
+
+        seg_ids = self._segment_ids(tokenizer)
+        out = []
+        for i in range(len(rows)):
+            ids = [] if skip_head else list(self._bos(tokenizer))
+            in_head = True
+            for s, seg in zip(self.segments, seg_ids):
+                if isinstance(s, Slot):
+                    in_head = False
+                    ids += filled[s.name][i]
+                elif not (skip_head and in_head):
+                    ids += seg
+            out.append(ids)
+        return out
+
+    def token_ids(self, tokenizer, **values):
+        return self.batch_ids(tokenizer, [values])[0]
+
+    def matches_full_tokenization(self, tokenizer, **values):
+        """True if splicing ids gives the same ids as tokenizing the rendered prompt."""
+        full = self._bos(tokenizer) + tokenizer(self.render(**values), add_special_tokens=False)["input_ids"]
+        return full == self.token_ids(tokenizer, **values)
+
+
+def left_pad(rows, pad_id, device=None):
+    """Stack id lists into left-padded input_ids and attention_mask tensors."""
+    width = max(len(ids) for ids in rows)
+    input_ids = torch.tensor([[pad_id] * (width - len(ids)) + ids for ids in rows], dtype=torch.long, device=device)
+    attention_mask = torch.tensor(
+        [[0] * (width - len(ids)) + [1] * len(ids) for ids in rows], dtype=torch.long, device=device
+    )
+    return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+# Templates shared by every generation path, by name
+PROMPTS = {}
+
+def register_prompt(name, segments, add_bos=True):
+    template = PromptTemplate(name, segments, add_bos)
+    PROMPTS[name] = template
+    return template
+
+def get_prompt(name):
+    return PROMPTS[name]
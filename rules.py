@@ -0,0 +1,173 @@
+import itertools
+import random
+
+import numpy as np
+
+from .logic import RED_FLAG_RESULT
+from .encoding import CODEBOOK, QUESTION_INDEX, encode_answers
+
+# -----------------------------
+# RED-FLAG RULES
+# -----------------------------
+# Each rule fires when all of its clauses hold; a clause holds when any of
+# its conditions does. A condition is (question id, operator, value), with
+# operators "==", "!=", "in" and "not in". None stands for "not answered".
+RED_FLAG_RULES = [
+    ("critical_event", [[("Q21", "==", "Yes"), ("Q22", "==", "Yes"), ("Q23", "==", "Yes")]]),
+    ("not_responding", [[("Q3", "==", "Yes")]]),
+    ("neck_stiffness", [[("Q9", "==", "Yes")]]),
+    ("blood_in_vomit_or_stool", [[("Q11", "==", "Yes")]]),
+    ("respiratory_distress", [[("Q15", "==", "Yes"), ("Q16", "==", "Yes")]]),
+    ("head_injury_with_vomiting", [[("Q19", "==", "Yes")], [("Q20", "==", "Yes"), ("Q10", "==", "4+")]]),
+    ("chronic_illness_fast_breathing", [[("Q5", "==", "Yes")], [("Q14", "==", "Yes")]]),
+    ("dehydration_risk", [[("Q13", "==", "No")], [("Q10", "not in", (None, "None"))]]),
+    ("severe_pain_with_fever", [[("Q18", "==", "Yes")], [("Q6", "!=", None)]]),
+]
+
+# -----------------------------
+# ANSWER ENCODING
+# -----------------------------
+def encode_matrix(answer_sets):
+    """Codes for many answer dicts or AnswerVectors as an (n, questions) uint8 matrix."""
+    return np.array([encode_answers(a) for a in answer_sets], dtype=np.uint8).reshape(-1, len(CODEBOOK))
+
+# -----------------------------
+# COMPILED EVALUATOR
+# -----------------------------
+_OPERATORS = {
+    "==": lambda v, x: v == x,
+    "!=": lambda v, x: v != x,
+    "in": lambda v, x: v in x,
+    "not in": lambda v, x: v not in x,
+}
+
+def _condition_source(q_id, op, operand):
+    value = f"get({q_id!r})"
+    if operand is None and op in ("==", "!="):
+        return f"{value} {'is' if op == '==' else 'is not'} None"
+    return f"{value} {op} {operand!r}"
+
+def compile_first_match(rules):
+    """
+    The rules as one generated function of short-circuiting comparisons, in
+    rule order, the shape of the hand-written check_red_flags. Operands are
+    validated against the question options first, so their reprs are safe.
+    """
+    lines = ["def first_match(answers):", "    get = answers.get"]
+    for name, rule in rules:
+        test = " and ".join("(" + " or ".join(_condition_source(*c) for c in clause) + ")" for clause in rule)
+        lines += [f"    if {test}:", f"        return {name!r}"]
+    lines.append("    return None")
+    namespace = {}
+    exec(compile("\n".join(lines), "<red-flag-rules>", "exec"), namespace)
+    return namespace["first_match"]
+
+class RedFlagEngine:
+    """
+    Rules compiled twice. For encoded matrices, into lookup tables: for every
+    referenced question and answer code, the bitmask of clauses that code
+    satisfies. An assessment's satisfied clauses are the OR of one table entry
+    per question, and a rule fires when all of its clause bits are set. For
+    single answer dicts, into straight-line comparisons (compile_first_match).
+    """
+
+    def __init__(self, rules=RED_FLAG_RULES):
+        self.names = [name for name, _ in rules]
+        clauses = [clause for _, rule in rules for clause in rule]
+        if len(clauses) > 64:
+            raise ValueError("At most 64 red-flag clauses are supported")
+
+        self.rule_masks = []
+        bit = 0
+        for _, rule in rules:
+            self.rule_masks.append(((1 << len(rule)) - 1) << bit)
+            bit += len(rule)
+
+        tables = {}
+        for bit, clause in enumerate(clauses):
+            for q_id, op, operand in clause:
+                if q_id not in QUESTION_INDEX:
+                    raise ValueError(f"Red-flag rule references unknown question {q_id}")
+                if op not in _OPERATORS:
+                    raise ValueError(f"Unknown red-flag operator {op!r}")
+                index = QUESTION_INDEX[q_id]
+                values = CODEBOOK[index][1]
+                for v in (operand if op in ("in", "not in") else (operand,)):
+                    if v is not None and v not in values:
+                        raise ValueError(f"{v!r} is not an answer to {q_id}")
+                table = tables.setdefault(index, [0] * (len(values) + 2))
+                # Code 0 is "not answered"; the last code is any value not in the options
+                for code, value in enumerate([None] + values + [_Other()]):
+                    if _OPERATORS[op](value, operand):
+                        table[code] |= 1 << bit
+
+        self.indexes = sorted(tables)
+        self.tables = [tables[i] for i in self.indexes]
+        # Single-dict path skips encoding and stops at the first firing rule
+        self._first_match = compile_first_match(rules)
+        self._np_tables = [np.array(t, dtype=np.uint64) for t in self.tables]
+        self._np_rule_masks = np.array(self.rule_masks, dtype=np.uint64)
+
+    def first_match(self, answers):
+        """Name of the first rule that fires for an answer dict, or None."""
+        return self._first_match(answers)
+
+    def evaluate_matrix(self, codes):
+        """
+        Index of the first firing rule per row of an encoded (n, questions)
+        matrix, or -1 where none fires, in one vectorized pass.
+        """
+        codes = np.asarray(codes)
+        satisfied = np.zeros(codes.shape[0], dtype=np.uint64)
+        for index, table in zip(self.indexes, self._np_tables):
+            satisfied |= table[codes[:, index]]
+        fired = (satisfied[:, None] & self._np_rule_masks) == self._np_rule_masks
+        return np.where(fired.any(axis=1), fired.argmax(axis=1), -1)
+
+    def screen(self, answers):
+        """Same contract as check_red_flags: the RED result or None."""
+        return dict(RED_FLAG_RESULT) if self._first_match(answers) is not None else None
+
+    def screen_batch(self, answer_sets):
+        """check_red_flags over many answer dicts: a RED result or None each."""
+        matches = self.evaluate_matrix(encode_matrix(answer_sets))
+        return [dict(RED_FLAG_RESULT) if m >= 0 else None for m in matches.tolist()]
+
+
+class _Other:
+    """Stands in for an answer that is none of a question's options."""
+
+    def __eq__(self, other):
+        return False
+
+    def __ne__(self, other):
+        return True
+
+    __hash__ = object.__hash__
+
+
+red_flag_engine = RedFlagEngine()
+
+
+# -----------------------------
+# CHECK CORPORA
+# -----------------------------
+# Shared by tests/test_rules.py and `bench.py red-flags`
+def exhaustive_answers(engine=red_flag_engine):
+    """Every combination of valid answers to the questions the rules reference."""
+    referenced = [CODEBOOK[i] for i in engine.indexes]
+    ids = [q_id for q_id, _ in referenced]
+    return [dict(zip(ids, combo)) for combo in itertools.product(*(values for _, values in referenced))]
+
+def sampled_answers(samples=20000, seed=0):
+    """Random answer sets that also leave questions unanswered and use unexpected values."""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(samples):
+        answers = {}
+        for q_id, values in CODEBOOK:
+            value = rng.choice([None, "unexpected", 3] + values)
+            if value is not None:
+                answers[q_id] = value
+        corpus.append(answers)
+    return corpus
@@ -1,9 +1,11 @@
 from pydantic import BaseModel
-from typing import Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 class TriageRequest(BaseModel):
     answers: Dict[str, Union[str, int, float]]
     language: str = "en"
+    # Return a scored level with generic advice first; fetch reasoning later by assessment_id
+    defer_reasoning: bool = False
 
 class TriageResponse(BaseModel):
     triage_level: str
@@ -11,3 +13,19 @@ class TriageResponse(BaseModel):
     confidence: str
     home_advice: List[str]
     advice_texts: Optional[List[str]] = []
+    level_probabilities: Optional[Dict[str, float]] = None
+    # Advice is the default for the level, not chosen by the model for these answers
+    generic_advice: bool = False
+    assessment_id: Optional[str] = None
+    reasoning_pending: bool = False
+
+class ReasoningResponse(BaseModel):
+    assessment_id: str
+    status: str  # "pending", "ready" or "failed"
+    reasoning: Optional[str] = None
+
+class TriageBatchRequest(BaseModel):
+    # Each item should be a TriageRequest object; items (even non-objects) are
+    # validated one by one so a bad item is reported in the results instead of
+    # rejecting the whole batch
+    items: List[Any]
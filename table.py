@@ -0,0 +1,320 @@
+import argparse
+import hashlib
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+
+from .logic import (
+    QUESTIONS, HOME_ADVICE_LIBRARY, check_red_flags, build_summary, classify_batch, answers_cache_key,
+    model_signature, cacheable, CLASSIFY_MODE
+)
+from .encoding import answer_vector
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# CONFIG
+# -----------------------------
+DEFAULT_TABLE_PATH = os.environ.get("TRIAGE_TABLE_PATH", "triage_table.bin")
+
+# Prior used for weighted enumeration when no frequency file is supplied:
+# most findings are absent in everyday clinic traffic.
+DEFAULT_YES_WEIGHT = 0.1
+# Yes/No questions where "Yes" is the normal finding
+DEFAULT_WEIGHTS = {
+    "Q4": {"Yes": 0.9, "No": 0.1},
+    "Q13": {"Yes": 0.9, "No": 0.1},
+}
+
+# -----------------------------
+# BINARY LAYOUT
+# -----------------------------
+# Header: magic, format version, slot count, entry count, strings offset, model/prompt fingerprint
+MAGIC = b"GCTT"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<4sHxxIIQ8s")
+# Slot: answers hash, level code, advice bitmask, reserved, reasoning offset, confidence offset
+SLOT = struct.Struct("<QBBHII")
+STRING_LEN = struct.Struct("<H")
+
+LEVELS = ["", "RED", "YELLOW", "GREEN"]
+ADVICE_KEYS = list(HOME_ADVICE_LIBRARY)
+
+
+def fingerprint():
+    """
+    Identifies the model, configured precision, prompt and decoding mode a
+    table was built with (see model_signature).
+    """
+    return hashlib.blake2b(model_signature().encode(), digest_size=8).digest()
+
+
+def answers_hash(answers):
+    """
+    Stable 64-bit hash of the answers (0 marks an empty slot): the
+    AnswerVector hash, or a hash of the canonical key for answers that
+    do not encode.
+    """
+    vector = answer_vector(answers)
+    if vector is not None:
+        return vector.hash64() or 1
+    _, encoded = answers_cache_key(answers)
+    digest = hashlib.blake2b(json.dumps(encoded, ensure_ascii=False).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+# -----------------------------
+# LOOKUP
+# -----------------------------
+class TriageTable:
+    """
+    Read-only, memory-mapped open-addressing table of precomputed classify()
+    results. Lookups hash the answers and probe a few fixed-size slots.
+    """
+
+    def __init__(self, buf):
+        self._buf = buf
+        magic, version, self.slot_count, self.entry_count, self._strings, fp = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Not a triage table or unsupported format version")
+        if fp != fingerprint():
+            raise ValueError("Triage table was built for a different model, prompt or decoding mode")
+        self._mask = self.slot_count - 1
+
+    @classmethod
+    def load(cls, path=DEFAULT_TABLE_PATH):
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(buf)
+        except Exception:
+            buf.close()
+            raise
+
+    def __len__(self):
+        return self.entry_count
+
+    def _string(self, offset):
+        start = self._strings + offset
+        (length,) = STRING_LEN.unpack_from(self._buf, start)
+        start += STRING_LEN.size
+        return self._buf[start:start + length].decode("utf-8")
+
+    def entries(self):
+        """Yield (answers hash, result) for every stored entry."""
+        for slot in range(self.slot_count):
+            h, level, advice, _, reasoning, confidence = SLOT.unpack_from(self._buf, HEADER.size + slot * SLOT.size)
+            if h:
+                yield h, self._result(level, advice, reasoning, confidence)
+
+    def _result(self, level, advice, reasoning, confidence):
+        return {
+            "triage_level": LEVELS[level],
+            "reasoning": self._string(reasoning),
+            "confidence": self._string(confidence),
+            "home_advice": [k for i, k in enumerate(ADVICE_KEYS) if advice >> i & 1],
+            # The fingerprint ties the table to the mode, so score-mode tables hold scored results
+            "generic_advice": CLASSIFY_MODE == "score",
+        }
+
+    def lookup(self, answers):
+        if not self.slot_count:
+            return None
+        key = answers_hash(answers)
+        slot = key & self._mask
+        for _ in range(self.slot_count):
+            h, level, advice, _, reasoning, confidence = SLOT.unpack_from(self._buf, HEADER.size + slot * SLOT.size)
+            if h == 0:
+                return None
+            if h == key:
+                return self._result(level, advice, reasoning, confidence)
+            slot = (slot + 1) & self._mask
+        return None
+
+
+def load_table(path=DEFAULT_TABLE_PATH):
+    """
+    Load the materialized table if one has been built and still matches the
+    running model, prompt and decoding mode, otherwise None. A stale or
+    unreadable table is skipped with a warning so the service still starts.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        return TriageTable.load(path)
+    except (ValueError, OSError, struct.error) as e:
+        logger.warning("Ignoring triage table %s: %s. Rebuild it with `python -m package.table`.", path, e)
+        return None
+
+
+# -----------------------------
+# BUILD
+# -----------------------------
+def write_table(path, entries):
+    """Write (answers, result) pairs to `path` in the mmap-able layout."""
+    slot_count = 1
+    while slot_count < 2 * len(entries):
+        slot_count <<= 1
+    slots = bytearray(slot_count * SLOT.size)
+    strings = bytearray()
+    string_offsets = {}
+
+    def intern(text):
+        if text not in string_offsets:
+            data = text.encode("utf-8")[:0xFFFF]
+            string_offsets[text] = len(strings)
+            strings.extend(STRING_LEN.pack(len(data)) + data)
+        return string_offsets[text]
+
+    count = 0
+    for answers, res in entries:
+        key = answers_hash(answers)
+        advice = 0
+        for k in res.get("home_advice", []):
+            if k in HOME_ADVICE_LIBRARY:
+                advice |= 1 << ADVICE_KEYS.index(k)
+        record = SLOT.pack(
+            key, LEVELS.index(res["triage_level"]), advice, 0,
+            intern(str(res.get("reasoning", ""))), intern(str(res.get("confidence", "")))
+        )
+        slot = key & (slot_count - 1)
+        while True:
+            h = SLOT.unpack_from(slots, slot * SLOT.size)[0]
+            if h == 0 or h == key:
+                break
+            slot = (slot + 1) & (slot_count - 1)
+        if h == 0:
+            count += 1
+        slots[slot * SLOT.size:(slot + 1) * SLOT.size] = record
+
+    strings_offset = HEADER.size + len(slots)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, slot_count, count, strings_offset, fingerprint()))
+        f.write(slots)
+        f.write(strings)
+    return count
+
+
+def question_choices(weights=None):
+    """Per-question (value, weight) choices, most likely first."""
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    choices = []
+    for qs in QUESTIONS.values():
+        for q_id, q_data in qs.items():
+            if q_data["type"] == "number":
+                values = list(range(q_data["min"], q_data["max"] + 1))
+                default = {v: 1.0 for v in values}
+            else:
+                values = list(q_data["options"])
+                if set(values) == {"Yes", "No"}:
+                    default = {"Yes": DEFAULT_YES_WEIGHT, "No": 1.0 - DEFAULT_YES_WEIGHT}
+                else:
+                    default = {v: 1.0 for v in values}
+            given = weights.get(q_id, {})
+            w = {v: float(given.get(str(v), default[v])) for v in values}
+            total = sum(w.values()) or 1.0
+            ranked = sorted(((v, w[v] / total) for v in values if w[v] > 0), key=lambda x: -x[1])
+            choices.append((q_id, ranked))
+    return choices
+
+
+def enumerate_weighted(limit, weights=None):
+    """
+    Yield the `limit` most probable non-red-flag answer sets, assuming
+    independent per-question weights. Best-first search over option ranks.
+    """
+    choices = question_choices(weights)
+    cost = lambda idx: -sum(math.log(ranked[i][1]) for (_, ranked), i in zip(choices, idx))
+    start = tuple(0 for _ in choices)
+    heap = [(cost(start), start)]
+    seen = {start}
+    produced = 0
+    while heap and produced < limit:
+        _, idx = heapq.heappop(heap)
+        answers = {q_id: ranked[i][0] for (q_id, ranked), i in zip(choices, idx)}
+        if not check_red_flags(answers):
+            produced += 1
+            yield answers
+        for pos, (_, ranked) in enumerate(choices):
+            if idx[pos] + 1 < len(ranked):
+                nxt = idx[:pos] + (idx[pos] + 1,) + idx[pos + 1:]
+                if nxt not in seen:
+                    seen.add(nxt)
+                    heapq.heappush(heap, (cost(nxt), nxt))
+
+
+def enumerate_frequencies(path, limit):
+    """
+    Read observed answer sets from a JSONL file of {"answers": {...}, "count": n}
+    lines and yield the `limit` most frequent non-red-flag ones.
+    """
+    counts = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            answers = row["answers"]
+            key = answers_cache_key(answers)
+            prev = counts.get(key, (0, answers))
+            counts[key] = (prev[0] + row.get("count", 1), answers)
+    ranked = sorted(counts.values(), key=lambda x: -x[0])
+    produced = 0
+    for _, answers in ranked:
+        if produced >= limit:
+            break
+        if not check_red_flags(answers):
+            produced += 1
+            yield answers
+
+
+def build_table(answer_sets, path=DEFAULT_TABLE_PATH, batch_size=8):
+    """Classify `answer_sets` in batches and materialize the results."""
+    entries = []
+    batch = []
+
+    def flush():
+        results = classify_batch([build_summary(a) for a in batch])
+        for answers, res in zip(batch, results):
+            # Precautionary fallbacks are not worth pinning in the table
+            if cacheable(res):
+                entries.append((answers, res))
+        batch.clear()
+
+    for answers in answer_sets:
+        batch.append(answers)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return write_table(path, entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Materialize classify() results for frequent answer sets.")
+    parser.add_argument("--out", default=DEFAULT_TABLE_PATH, help="Output table path")
+    parser.add_argument("--limit", type=int, default=1000, help="Number of answer sets to materialize")
+    parser.add_argument("--frequencies", help="JSONL file of observed answers with counts")
+    parser.add_argument("--weights", help="JSON file of per-question option weights for enumeration")
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.frequencies:
+        answer_sets = enumerate_frequencies(args.frequencies, args.limit)
+    else:
+        weights = None
+        if args.weights:
+            with open(args.weights, encoding="utf-8") as f:
+                weights = json.load(f)
+        answer_sets = enumerate_weighted(args.limit, weights)
+
+    count = build_table(answer_sets, args.out, args.batch_size)
+    print(f"Wrote {count} entries to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import threading
+import time
+
+from package.logic import ModelHolder
+
+
+def test_concurrent_first_requests_load_once():
+    threads = 32
+
+    def slow_loader():
+        time.sleep(0.2)
+        return object(), object()
+
+    holder = ModelHolder(loader=slow_loader, max_concurrent=1)
+    barrier = threading.Barrier(threads)
+    seen = []
+    lock = threading.Lock()
+
+    def first_request():
+        barrier.wait()
+        with holder.acquire() as pair:
+            with lock:
+                seen.append(pair)
+
+    workers = [threading.Thread(target=first_request) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    assert holder.loads == 1
+    assert len(seen) == threads
+    assert all(pair is seen[0] for pair in seen)
+    assert holder.refs == 0
+
+
+def test_unload_waits_for_held_slots():
+    holder = ModelHolder(loader=lambda: (object(), object()))
+    with holder.acquire():
+        assert not holder.unload()
+        assert holder.loaded
+    assert holder.unload()
+    assert not holder.loaded
@@ -0,0 +1,36 @@
+import pytest
+
+from package.logic import check_red_flags
+from package.encoding import AnswerVector
+from package.rules import RedFlagEngine, red_flag_engine, encode_matrix, exhaustive_answers, sampled_answers
+
+
+@pytest.mark.parametrize("corpus", [exhaustive_answers(), sampled_answers()], ids=["exhaustive", "sampled"])
+def test_compiled_rules_match_reference(corpus):
+    expected = [check_red_flags(a) for a in corpus]
+    assert [red_flag_engine.screen(a) for a in corpus] == expected
+    assert red_flag_engine.screen_batch(corpus) == expected
+    fired = red_flag_engine.evaluate_matrix(encode_matrix(corpus)) >= 0
+    assert fired.tolist() == [e is not None for e in expected]
+
+
+def test_first_match_agrees_with_tables():
+    corpus = sampled_answers(5000, seed=1)
+    indexes = red_flag_engine.evaluate_matrix(encode_matrix(corpus)).tolist()
+    names = [red_flag_engine.names[i] if i >= 0 else None for i in indexes]
+    assert [red_flag_engine.first_match(a) for a in corpus] == names
+
+
+def test_answer_vectors_screen_like_dicts():
+    for answers in sampled_answers(2000, seed=2):
+        valid = {q: v for q, v in answers.items() if v not in ("unexpected", 3)}
+        assert red_flag_engine.screen(AnswerVector.from_dict(valid)) == check_red_flags(valid)
+
+
+def test_rules_are_validated():
+    with pytest.raises(ValueError):
+        RedFlagEngine([("bad", [[("Q999", "==", "Yes")]])])
+    with pytest.raises(ValueError):
+        RedFlagEngine([("bad", [[("Q3", "==", "Maybe")]])])
+    with pytest.raises(ValueError):
+        RedFlagEngine([("bad", [[("Q3", "~", "Yes")]])])